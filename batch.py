@@ -0,0 +1,621 @@
+import os
+import re
+import zlib
+import threading
+from queue import Queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+from utils import IMAGE_NOT_READ, NOT_COLOR_IMAGE, NO_LEAF, decode_image, mask_iou, original_size
+from instrumentation import Metrics, NO_METRICS
+from manifest import MANIFEST_FILE
+from segment import ALGORITHM_VERSION, Segmenter, read_image_file, read_image_bytes, \
+    leaf_mask, output_filename, write_segmented, upscale_mask, decode_scale_params
+
+
+# marks the end of items passed between pipeline stages
+END_OF_FILES = None
+
+# extensions of image files listed when scanning folders recursively
+IMAGE_EXTENSIONS = re.compile(r'\.(jpe?g|png|bmp|tiff?|webp)$', re.I)
+
+# outputs, their temporary files and the manifest of a run, not listed
+# when a folder is segmented into itself
+RUN_OUTPUTS = re.compile(r'_marked(_merged)?(\.\d+\.tmp)?\.\w+$|^' + re.escape(MANIFEST_FILE))
+
+# messages reported for image files that could not be segmented
+ERROR_MESSAGES = {
+    IMAGE_NOT_READ: 'Error: Could not read image file: ',
+    NOT_COLOR_IMAGE: 'Error: Not color image file: ',
+    NO_LEAF: 'Error: No leaf found in image file: ',
+}
+
+# message reported for image files that failed with an unexpected error
+UNEXPECTED_ERROR_MESSAGE = 'Error: Could not segment image file ({}): '
+
+# segmenter and result cache of a pool process, set up once by init_worker
+worker_segmenter = None
+worker_cache = None
+
+
+def error_code(err):
+    """
+    Get the error reported for an image file from the exception it raised
+
+    Args:
+        err (Exception): exception raised segmenting the file
+
+    Returns:
+        error code of ERROR_MESSAGES, or the type and message of an unexpected error
+    """
+    if isinstance(err, ValueError) and str(err) in ERROR_MESSAGES:
+        return str(err)
+
+    return '{}: {}'.format(type(err).__name__, err)
+
+
+def error_message(error):
+    """
+    Get the message reported for an image file that couldn't be segmented
+
+    Args:
+        error (string): error of the file, see error_code
+
+    Returns:
+        message to be followed by the filename
+    """
+    if error in ERROR_MESSAGES:
+        return ERROR_MESSAGES[error]
+
+    return UNEXPECTED_ERROR_MESSAGE.format(error)
+
+
+def scan_files(folder, recursive=False, pattern=None, exclude=None):
+    """
+    List the files of a folder lazily, a folder at a time
+
+    When exclude is folder itself outputs are written among the files being
+    listed, so each folder is listed in full and sorted before its files are
+    yielded, and the outputs of earlier runs are skipped
+
+    Args:
+        folder (string): folder to list
+        recursive (boolean): also list files of subfolders, symbolic links
+                             to folders are not followed
+        pattern (compiled regex or None): filenames must match it, all files if None
+        exclude (string or None): folder not to descend into, such as
+                                  a destination inside folder
+
+    Returns:
+        generator of filenames relative to folder
+    """
+    exclude = os.path.realpath(exclude) if exclude else None
+    into_itself = exclude == os.path.realpath(folder)
+    folders = ['']
+    while folders:
+        relative = folders.pop()
+        with os.scandir(os.path.join(folder, relative)) as entries:
+            if into_itself:
+                entries = sorted(entries, key=lambda entry: entry.name)
+            for entry in entries:
+                name = os.path.join(relative, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and os.path.realpath(entry.path) != exclude:
+                        folders.append(name)
+                elif entry.is_file() and (pattern is None or pattern.search(entry.name)) \
+                        and not (into_itself and RUN_OUTPUTS.search(entry.name)):
+                    yield name
+
+
+def shard_files(files, index, count):
+    """
+    Keep the files of one shard of a dataset split by hash of the file paths
+
+    A file belongs to the same shard on every machine, so count machines
+    can each segment one shard of a dataset without coordinating
+
+    Args:
+        files (iterable of strings): filenames relative to the dataset folder
+        index (int): shard to keep, 0 <= index < count
+        count (int): number of shards
+
+    Returns:
+        generator of files of the shard
+    """
+    for file in files:
+        # hashed with / as separator so every platform splits the same way
+        if zlib.crc32(file.replace(os.sep, '/').encode()) % count == index:
+            yield file
+
+
+def settings_segmenter(settings, metrics=None):
+    """
+    Set up a segmenter with the settings of a run
+
+    Args:
+        settings (dict): see segment_file
+        metrics (Metrics or None): metrics recording the stages, None to not record
+
+    Returns:
+        Segmenter
+    """
+    return Segmenter(settings['filling_mode'], settings['smooth_boundary'],
+                     settings['marker_intensity'], settings['use_lut'],
+                     settings['coarse_scale'], metrics, settings['engine'])
+
+
+def settings_params(settings):
+    """
+    Get the settings of a run outputs depend on
+
+    Args:
+        settings (dict): see segment_file
+
+    Returns:
+        dict of algorithm version and output settings
+    """
+    params = {key: settings[key] for key in (
+        'filling_mode', 'smooth_boundary', 'marker_intensity', 'with_original', 'use_lut',
+        'coarse_scale', 'decode_scale', 'upscale', 'mask_format', 'engine')}
+    params['version'] = ALGORITHM_VERSION
+
+    return params
+
+
+def settings_cache(settings):
+    """
+    Set up the result cache of a run
+
+    Args:
+        settings (dict): see segment_file
+
+    Returns:
+        ResultCache, or None if settings['cache_dir'] is not set
+    """
+    if settings['cache_dir'] is None:
+        return None
+
+    from cache import ResultCache
+    return ResultCache(settings['cache_dir'], settings['cache_size'])
+
+
+def init_worker(settings):
+    """
+    Set up the segmenter and result cache of a pool process
+
+    Args:
+        settings (dict): see segment_file
+
+    Returns:
+        nothing
+    """
+    global worker_segmenter, worker_cache
+    metrics = Metrics(settings['trace_memory']) if settings['metrics'] else None
+    worker_segmenter = settings_segmenter(settings, metrics)
+    worker_cache = settings_cache(settings)
+
+
+def read_input(file, settings, segmenter, cache, metrics):
+    """
+    Read an image file, skipping decoding when its cached mask is all that is needed
+
+    Args:
+        file (string): filename of the image, relative to settings['base_folder']
+        settings (dict): see segment_file
+        segmenter (Segmenter): segmenter set up with the settings
+        cache (ResultCache or None): cache of leaf masks
+        metrics (Metrics): metrics recording the decode stage
+
+    Returns:
+        tuple[0] (ndarray or None): bgr image reduced by settings['decode_scale'],
+                                    None if not needed
+        tuple[1] (ndarray or None): cached leaf mask, None if not cached
+        tuple[2] (string or None): key of the result in cache
+        tuple[3] (tuple or None): full size of the image the mask is upscaled to,
+                                  None to keep the decoded size
+        tuple[4] (ndarray or None): bgr image at full size when the mask is upscaled
+                                    and the output needs the image, otherwise None
+    """
+    path = os.path.join(settings['base_folder'], file)
+    decode_scale = settings['decode_scale']
+    upscale = settings['upscale'] and decode_scale > 1
+    mask_only = settings['marker_intensity'] > 0 and not settings['with_original']
+
+    if cache is None and not upscale:
+        with metrics.stage('decode') as stage:
+            original = read_image_file(path, decode_scale)
+            stage.pixels = original.shape[0] * original.shape[1]
+        return original, None, None, None, None
+
+    data = read_image_bytes(path)
+    key = largest_mask = None
+    if cache is not None:
+        key = cache.key(data, decode_scale_params(segmenter.cache_params(), decode_scale))
+        largest_mask = cache.get(key)
+
+    original = None
+    # a mask output alone doesn't need the original image
+    if largest_mask is None or not mask_only:
+        with metrics.stage('decode') as stage:
+            original = decode_image(data, decode_scale=decode_scale)
+            stage.pixels = original.shape[0] * original.shape[1]
+
+    if not upscale:
+        return original, largest_mask, key, None, None
+
+    reduced_shape = original.shape if original is not None else largest_mask.shape
+    size = original_size(data, reduced_shape, decode_scale)
+
+    full_original = None
+    if not mask_only:
+        with metrics.stage('decode') as stage:
+            full_original = decode_image(data)
+            stage.pixels = full_original.shape[0] * full_original.shape[1]
+
+    return original, largest_mask, key, size, full_original
+
+
+def segment_input(read_result, settings, segmenter, cache):
+    """
+    Segment an image read by read_input with the settings of a run
+
+    Args:
+        read_result (tuple): result of read_input for the image
+        settings (dict): see segment_file
+        segmenter (Segmenter): segmenter set up with the settings
+        cache (ResultCache or None): cache the segmented leaf mask is put in
+
+    Returns:
+        tuple[0] (ndarray or None): original image of the output
+        tuple[1] (ndarray): output of segment_leaf for the image
+        tuple[2] (dict): stats of the image, iou with the full resolution
+                         mask when settings['compare_full'] is set and
+                         cache 'hit' or 'miss' when a cache is used
+    """
+    original, largest_mask, key, size, full_original = read_result
+
+    stats = {}
+    if cache is not None:
+        stats['cache'] = 'miss' if largest_mask is None else 'hit'
+
+    if largest_mask is None:
+        largest_mask = segmenter.mask(original)
+        if cache is not None:
+            cache.put(key, largest_mask)
+
+        if settings['compare_full']:
+            stats['iou'] = mask_iou(largest_mask,
+                                    leaf_mask(original, settings['filling_mode'],
+                                              settings['smooth_boundary'], settings['use_lut'],
+                                              engine=settings['engine']))
+
+    if size is not None:
+        largest_mask = upscale_mask(largest_mask, size)
+        original = full_original
+
+    # the original image is not written, so segment it in place
+    out = None
+    if settings['marker_intensity'] == 0 and not settings['with_original']:
+        out = original
+
+    return original, segmenter.output(original, largest_mask, out), stats
+
+
+def segment_file(file, settings, segmenter, cache=None):
+    """
+    Segment an image file and write its output
+
+    Args:
+        file (string): filename of the image, relative to settings['base_folder']
+        settings (dict): base_folder, destination, filling_mode, smooth_boundary,
+                         marker_intensity, with_original, use_lut, coarse_scale,
+                         compare_full, metrics, trace_memory, cache_dir, cache_size,
+                         decode_scale, upscale, mask_format and engine of the run
+        segmenter (Segmenter): segmenter set up with the settings
+        cache (ResultCache or None): cache of leaf masks
+
+    Returns:
+        tuple[0] (string): file
+        tuple[1] (string or None): error of the file if it couldn't be segmented,
+                                   see error_code, otherwise None
+        tuple[2] (dict): stats of the file, see segment_input
+    """
+    metrics = segmenter.metrics
+    metrics.label = file
+    try:
+        read_result = read_input(file, settings, segmenter, cache, metrics)
+        original, output_image, stats = segment_input(read_result, settings, segmenter, cache)
+
+        with metrics.stage('encode', output_image.shape[0] * output_image.shape[1]):
+            write_segmented(output_filename(file, settings['destination'],
+                                            settings['with_original'], settings['mask_format']),
+                            original, output_image,
+                            settings['marker_intensity'], settings['with_original'],
+                            settings['mask_format'])
+    except Exception as err:
+        # a file failing must not abort the files after it, or a pool's other chunks
+        return file, error_code(err), {}
+
+    return file, None, stats
+
+
+def segment_files(files, settings):
+    """
+    Segment a chunk of image files in a pool process, see segment_file
+
+    Returns:
+        tuple[0] (list): segment_file results in order of files
+        tuple[1] (list): metrics records of the chunk
+    """
+    results = [segment_file(file, settings, worker_segmenter, worker_cache)
+               for file in files]
+
+    return results, worker_segmenter.metrics.drain()
+
+
+def run_serial(files, settings, metrics=None):
+    """
+    Segment image files one after another
+
+    Args:
+        files (iterable of strings): filenames relative to settings['base_folder']
+        settings (dict): see segment_file
+        metrics (Metrics or None): metrics recording the stages, None to not record
+
+    Returns:
+        generator of segment_file results in order of files
+    """
+    segmenter = settings_segmenter(settings, metrics)
+    cache = settings_cache(settings)
+    for file in files:
+        yield segment_file(file, settings, segmenter, cache)
+
+
+def run_parallel(files, settings, jobs, chunksize=4, ordered=True, metrics=None):
+    """
+    Segment image files on a pool of processes
+
+    Files are handed to the processes in chunks, and only a few chunks per
+    process are submitted ahead so files can be a lazy iterable of any size
+
+    Args:
+        files (iterable of strings): filenames relative to settings['base_folder']
+        settings (dict): see segment_file
+        jobs (int): number of processes
+        chunksize (int): number of files handed to a process at once
+        ordered (boolean): yield results in order of files rather than
+                           as soon as they complete
+        metrics (Metrics or None): metrics collecting records of the processes,
+                                   they record only if settings['metrics'] is set
+
+    Returns:
+        generator of segment_file results
+    """
+    files = iter(files)
+    max_pending = 2 * jobs
+
+    with ProcessPoolExecutor(jobs, initializer=init_worker,
+                             initargs=(settings,)) as executor:
+        def submit(count):
+            for _ in range(count):
+                chunk = list(islice(files, max(chunksize, 1)))
+                if not chunk:
+                    return
+                pending.append(executor.submit(segment_files, chunk, settings))
+
+        pending = deque()
+        submit(max_pending)
+
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+
+            for future in done:
+                chunk_results, records = future.result()
+                if metrics is not None:
+                    metrics.records.extend(records)
+                for result in chunk_results:
+                    yield result
+
+            submit(max_pending - len(pending))
+
+
+def run_pipeline(files, settings, queue_size=4, metrics=None):
+    """
+    Segment image files with reading, segmenting and writing overlapped
+
+    Each stage runs on its own thread and hands images to the next one
+    through a bounded queue, so a slow stage holds the others back and
+    at most about 2 * queue_size images are held in memory
+
+    Args:
+        files (iterable of strings): filenames relative to settings['base_folder']
+        settings (dict): see segment_file
+        queue_size (int): number of images each queue may hold
+        metrics (Metrics or None): metrics recording the stages, None to not record,
+                                   allocated bytes overlap between stages running
+                                   at the same time
+
+    Returns:
+        generator of segment_file results in order of files
+    """
+    read_queue = Queue(maxsize=queue_size)
+    write_queue = Queue(maxsize=queue_size)
+    results = Queue()
+
+    # every thread records its own stages, collected once all files are done
+    if metrics is None:
+        read_metrics = segment_metrics = write_metrics = NO_METRICS
+    else:
+        read_metrics, segment_metrics, write_metrics = Metrics(), Metrics(), Metrics()
+    segmenter = settings_segmenter(settings, segment_metrics)
+    cache = settings_cache(settings)
+
+    def pass_on(stage, source, target):
+        # items are (file, payload, error), errors skip the remaining stages
+        while True:
+            item = source.get()
+            if item is END_OF_FILES:
+                target.put(END_OF_FILES)
+                return
+
+            file, payload, error = item
+            if error is None:
+                try:
+                    payload = stage(file, payload)
+                except Exception as err:
+                    error = error_code(err)
+            target.put((file, payload, error))
+
+    def read(file, _):
+        read_metrics.label = file
+        return read_input(file, settings, segmenter, cache, read_metrics)
+
+    def segment(file, read_result):
+        segment_metrics.label = file
+        return segment_input(read_result, settings, segmenter, cache)
+
+    def write(file, images):
+        original, output_image, stats = images
+        write_metrics.label = file
+        with write_metrics.stage('encode', output_image.shape[0] * output_image.shape[1]):
+            write_segmented(output_filename(file, settings['destination'],
+                                            settings['with_original'], settings['mask_format']),
+                            original, output_image,
+                            settings['marker_intensity'], settings['with_original'],
+                            settings['mask_format'])
+        return stats
+
+    def run_stage(stage, source, target):
+        try:
+            pass_on(stage, source, target)
+        except BaseException as err:
+            # hand unexpected errors to the consumer rather than dying silently
+            results.put(err)
+
+    file_queue = Queue(maxsize=queue_size)
+
+    def list_files():
+        try:
+            for file in files:
+                file_queue.put((file, None, None))
+        except BaseException as err:
+            results.put(err)
+        file_queue.put(END_OF_FILES)
+
+    threads = [
+        threading.Thread(target=list_files, daemon=True),
+        threading.Thread(target=run_stage, args=(read, file_queue, read_queue), daemon=True),
+        threading.Thread(target=run_stage, args=(segment, read_queue, write_queue), daemon=True),
+        threading.Thread(target=run_stage, args=(write, write_queue, results), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    while True:
+        item = results.get()
+        if item is END_OF_FILES:
+            if metrics is not None:
+                for stage_metrics in (read_metrics, segment_metrics, write_metrics):
+                    metrics.records.extend(stage_metrics.drain())
+            break
+        if isinstance(item, BaseException):
+            raise item
+
+        file, stats, error = item
+        yield file, error, stats if error is None else {}
+
+
+def run_shared_memory(files, settings, jobs, slots=None, metrics=None):
+    """
+    Segment image files on a pool of processes passed images through shared memory
+
+    Images are decoded on a thread of this process, then copied into a slot
+    of a SharedMemoryPool, segmented there by the pool processes and written
+    from the slot, so neither images nor outputs are pickled between processes
+
+    Args:
+        files (iterable of strings): filenames relative to settings['base_folder']
+        settings (dict): see segment_file, cache_dir, compare_full and upscale
+                         are not supported
+        jobs (int): number of processes
+        slots (int or None): number of images in flight, twice jobs if None
+        metrics (Metrics or None): metrics recording decoding and writing,
+                                   stages of the pool processes are not recorded
+
+    Returns:
+        generator of segment_file results in order of files
+    """
+    from shm_pool import SharedMemoryPool
+
+    items = Queue()
+    read_metrics = NO_METRICS if metrics is None else Metrics()
+    write_metrics = NO_METRICS if metrics is None else metrics
+    keep_original = settings['with_original']
+
+    with SharedMemoryPool(settings['filling_mode'], settings['smooth_boundary'],
+                          settings['marker_intensity'], settings['use_lut'],
+                          settings['coarse_scale'], settings['engine'],
+                          jobs, slots) as pool:
+        def read():
+            # submitting waits for a free slot, which holds reading back
+            try:
+                for file in files:
+                    read_metrics.label = file
+                    try:
+                        with read_metrics.stage('decode') as stage:
+                            original = read_image_file(
+                                os.path.join(settings['base_folder'], file),
+                                settings['decode_scale'])
+                            stage.pixels = original.shape[0] * original.shape[1]
+                    except Exception as err:
+                        items.put((file, None, None, error_code(err)))
+                        continue
+                    items.put((file,) + pool.submit(original, keep_original) + (None,))
+            except BaseException as err:
+                items.put(err)
+            items.put(END_OF_FILES)
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+
+        while True:
+            item = items.get()
+            if item is END_OF_FILES:
+                if metrics is not None:
+                    metrics.records.extend(read_metrics.drain())
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            file, slot, future, error = item
+            if error is None:
+                try:
+                    original, output_image = pool.result(slot, future)
+                except BrokenExecutor:
+                    # the pool is gone, no file after this one can be segmented
+                    raise
+                except Exception as err:
+                    error = error_code(err)
+                else:
+                    write_metrics.label = file
+                    try:
+                        with write_metrics.stage('encode',
+                                                 output_image.shape[0] * output_image.shape[1]):
+                            write_segmented(output_filename(file, settings['destination'],
+                                                            settings['with_original'],
+                                                            settings['mask_format']),
+                                            original, output_image,
+                                            settings['marker_intensity'],
+                                            settings['with_original'], settings['mask_format'])
+                    except Exception as err:
+                        error = error_code(err)
+                    finally:
+                        del original, output_image
+                        pool.release(slot)
+            yield file, error, {}
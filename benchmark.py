@@ -0,0 +1,364 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import cv2
+
+from utils import *
+from background_marker import *
+from segment import leaf_mask, segment_image
+from otsu_segmentation import otsu_marker
+
+
+# modules timed when imported in a new interpreter, as a command line run does
+STARTUP_MODULES = ('segment', 'batch')
+
+# packages the segmentation path must not import, only review tools need them
+HEAVY_PACKAGES = ('matplotlib', 'scipy', 'PIL', 'review')
+
+# synthetic image sizes as (height, width)
+SIZES = {
+    '256': (256, 256),
+    '1mp': (1024, 1024),
+    '4mp': (2048, 2048),
+    '12mp': (3000, 4000),
+    '24mp': (4000, 6000),
+}
+
+
+def synthetic_leaf(height, width, seed=0):
+    """
+    Generate a synthetic image of a leaf on a plain background
+
+    The leaf is a noisy green ellipse with a stem and brown lesions in it,
+    lying on a noisy light background
+
+    Args:
+        height (int): image height
+        width (int): image width
+        seed (int): seed of the noise
+
+    Returns:
+        ndarray of a bgr image
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (200, 210, 215)
+
+    center = (width // 2, height // 2)
+    axes = (max(1, int(width * 0.35)), max(1, int(height * 0.25)))
+    cv2.ellipse(image, center, axes, 30, 0, 360, (40, 140, 60), -1)
+    cv2.line(image, center, (width - 1, height - 1), (50, 120, 70),
+             max(1, min(height, width) // 100))
+
+    # lesions become holes of the marker
+    for _ in range(8):
+        spot = (int(center[0] + rng.uniform(-0.5, 0.5) * axes[0]),
+                int(center[1] + rng.uniform(-0.5, 0.5) * axes[1]))
+        cv2.circle(image, spot, max(1, int(min(axes) * rng.uniform(0.02, 0.1))),
+                   (30, 60, 110), -1)
+
+    noise = rng.normal(0, 12, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def peak_memory(stage, setup):
+    """
+    Measure the peak memory a stage of the pipeline allocates with tracemalloc
+
+    Args:
+        stage (callable): called with the arguments returned by setup
+        setup (callable): returns fresh arguments of stage, not measured
+
+    Returns:
+        bytes allocated at the peak of the stage above what it started with
+    """
+    args = setup()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        stage(*args)
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+def measure(stage, setup, repeat, memory=False):
+    """
+    Time a stage of the pipeline
+
+    Args:
+        stage (callable): called with the arguments returned by setup
+        setup (callable): returns fresh arguments of stage, not timed
+        repeat (int): number of timed runs
+        memory (boolean): also measure peak memory, on a separate run
+                          as tracing slows the stage down
+
+    Returns:
+        dict of min, median and mean seconds of the runs,
+        and peak_bytes if memory is set, see peak_memory
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        stage(*args)
+        times.append(time.perf_counter() - start)
+
+    result = {
+        'min': min(times),
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times)),
+    }
+    if memory:
+        result['peak_bytes'] = peak_memory(stage, setup)
+
+    return result
+
+
+def marker_of(image):
+    """
+    Get the binary image select_largest_obj is given by segment_leaf
+    """
+    marker = np.full(image.shape[:2], True)
+    color_index_marker(index_diff(image), marker)
+
+    return marker.astype(np.uint8) * 255
+
+
+def benchmark_size(name, repeat, stages=None, memory=False):
+    """
+    Time every stage of the pipeline on a synthetic image of a size
+
+    Args:
+        name (string): key of SIZES
+        repeat (int): number of timed runs of each stage
+        stages (collection of strings or None): names of stages to time, all if None
+        memory (boolean): also measure peak memory of every stage
+
+    Returns:
+        dict of stage name to timings, see measure
+    """
+    height, width = SIZES[name]
+    image = synthetic_leaf(height, width)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    bin_image = marker_of(image)
+    largest_mask = select_largest_obj(bin_image, fill_mode=FILL['NO'])
+
+    results = {}
+
+    def add(stage_name, stage, setup):
+        if stages is None or stage_name in stages:
+            results[stage_name] = measure(stage, setup, repeat, memory)
+
+    with tempfile.TemporaryDirectory() as folder:
+        image_file = os.path.join(folder, 'leaf.jpg')
+        cv2.imwrite(image_file, image)
+        add('read_image', read_image, lambda: (image_file,))
+        for decode_scale in DECODE_SCALES[1:]:
+            add('read_image[scale={}]'.format(decode_scale),
+                lambda decode_scale=decode_scale:
+                    read_image(image_file, decode_scale=decode_scale),
+                lambda: ())
+
+    add('index_diff', index_diff, lambda: (image,))
+    add('color_index_marker', color_index_marker,
+        lambda: (index_diff(image), np.full((height, width), True)))
+    add('otsu_marker', otsu_marker, lambda: (image, np.empty((height, width), dtype=bool)))
+
+    for fill_name, fill_mode in FILL.items():
+        for smooth in (False, True):
+            stage_name = 'select_largest_obj[{}{}]'.format(
+                fill_name.lower(), ',smooth' if smooth else '')
+            add(stage_name,
+                lambda fill_mode=fill_mode, smooth=smooth:
+                    select_largest_obj(bin_image, fill_mode=fill_mode,
+                                       smooth_boundary=smooth),
+                lambda: ())
+
+    add('fill_holes', fill_holes, lambda: (largest_mask.copy(),))
+    add('leaf_mask', leaf_mask, lambda: (image, FILL['FLOOD'], False))
+    add('segment_image', segment_image, lambda: (image, FILL['FLOOD'], False, 0))
+    add('segment_image[in_place]',
+        lambda original: segment_image(original, FILL['FLOOD'], False, 0, in_place=True),
+        lambda: (image.copy(),))
+    # the otsu engine against the color index one above
+    add('leaf_mask[otsu]',
+        lambda: leaf_mask(image, FILL['FLOOD'], False, engine='otsu'),
+        lambda: ())
+    add('segment_image[otsu]',
+        lambda: segment_image(image, FILL['FLOOD'], False, 0, engine='otsu'),
+        lambda: ())
+    add('texture_filter', texture_filter,
+        lambda: (gray, np.full((height, width), True)))
+
+    return results
+
+
+def import_time(module):
+    """
+    Time importing a module in a new interpreter
+
+    Args:
+        module (string): name of a module of this package
+
+    Returns:
+        tuple[0] (float): seconds the import took
+        tuple[1] (list of strings): HEAVY_PACKAGES the import loaded
+    """
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps([seconds, sorted({{name.split(".")[0] for name in sys.modules}})]))'
+            .format(module))
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    seconds, packages = json.loads(output)
+
+    return seconds, [package for package in HEAVY_PACKAGES if package in packages]
+
+
+def benchmark_startup(repeat, stages=None):
+    """
+    Time importing the modules a command line run starts with
+
+    Args:
+        repeat (int): number of timed imports of each module
+        stages (collection of strings or None): names of stages to time, all if None
+
+    Returns:
+        dict of min, median and mean seconds of the imports, see measure,
+        and heavy packages they loaded by stage named import[module]
+    """
+    results = {}
+    for module in STARTUP_MODULES:
+        stage_name = 'import[{}]'.format(module)
+        if stages is not None and stage_name not in stages:
+            continue
+
+        times = []
+        for _ in range(repeat):
+            seconds, heavy = import_time(module)
+            times.append(seconds)
+        results[stage_name] = {
+            'min': min(times),
+            'median': float(np.median(times)),
+            'mean': float(np.mean(times)),
+            'heavy': heavy,
+        }
+
+    return results
+
+
+def environment():
+    """
+    Describe where a benchmark is run
+
+    Returns:
+        dict of commit, python, numpy, opencv and machine
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'processor_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare benchmark results with results of a baseline run
+
+    Args:
+        results (dict): results of this run
+        baseline (dict): results of the baseline run
+        tolerance (float): ratio of median times above which a stage regressed
+
+    Returns:
+        list of (size, stage, ratio) of regressed stages
+    """
+    baseline_sizes = dict(baseline['sizes'], startup=baseline.get('startup', {}))
+    regressions = []
+    for size, stages in dict(results['sizes'], startup=results['startup']).items():
+        for stage, timing in stages.items():
+            base = baseline_sizes.get(size, {}).get(stage)
+            if base is None or base['median'] <= 0:
+                continue
+
+            ratio = timing['median'] / base['median']
+            print('{:>5} {:<40} {:8.4f}s vs {:8.4f}s  x{:.2f}'
+                  .format(size, stage, timing['median'], base['median'], ratio),
+                  file=sys.stderr)
+            if ratio > tolerance:
+                regressions.append((size, stage, ratio))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('benchmark')
+    parser.add_argument('-s', '--sizes', nargs='+', choices=list(SIZES), default=list(SIZES),
+                        help='Sizes of synthetic images to benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timed runs of every stage')
+    parser.add_argument('--stages', nargs='+',
+                        help='Names of stages to benchmark, all if not specified')
+    parser.add_argument('-m', '--memory', action='store_true',
+                        help='Also measure peak memory every stage allocates with tracemalloc')
+    parser.add_argument('-o', '--output',
+                        help='JSON file to write results to, standard output if not specified')
+    parser.add_argument('-c', '--compare',
+                        help='JSON results of a baseline run to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.2,
+                        help='Ratio of median times above baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'environment': environment(),
+        'repeat': args.repeat,
+        'sizes': {},
+    }
+    print('Benchmarking startup', file=sys.stderr)
+    results['startup'] = benchmark_startup(args.repeat, args.stages)
+    for size in args.sizes:
+        print('Benchmarking size: ', size, file=sys.stderr)
+        results['sizes'][size] = benchmark_size(size, args.repeat, args.stages, args.memory)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for size, stage, ratio in regressions:
+            print('Regression: {} {} is {:.2f} times slower'.format(size, stage, ratio),
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+    # startup of a command line run is guarded regardless of a baseline
+    for stage, timing in results['startup'].items():
+        if timing['heavy']:
+            print('Regression: {} imports {}'.format(stage, ', '.join(timing['heavy'])),
+                  file=sys.stderr)
+    if any(timing['heavy'] for timing in results['startup'].values()):
+        sys.exit(1)
@@ -0,0 +1,174 @@
+import os
+import time
+import hashlib
+
+from mask_io import write_mask_npz, read_mask_npz
+
+
+# share of the size limit eviction brings the cache down to, so that a
+# sweep makes room for many masks rather than for the next one only
+LOW_WATER_RATIO = 0.9
+
+
+class ResultCache:
+    """
+    Content addressed cache of leaf masks on disk
+
+    Masks are stored bit packed under a hash of the image bytes and the
+    segmentation parameters, least recently used masks are evicted once
+    the cache grows beyond its size limit. The directory is scanned once,
+    the size and last use of masks are kept in memory from then on, so
+    masks other runs sharing the cache add meanwhile are counted only by
+    runs started after them
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        """
+        Args:
+            directory (string): directory of cached masks, created if missing
+            max_bytes (int): size the cached masks may take on disk
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # size and last use time of cached masks by path, scanned on first put
+        self.index = None
+        self.size = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, data, params):
+        """
+        Compute the key of a result
+
+        Args:
+            data (bytes): content of the image file
+            params (dict): parameters the result depends on, including algorithm version
+
+        Returns:
+            hex digest string
+        """
+        digest = hashlib.sha256(repr(sorted(params.items())).encode())
+        digest.update(data)
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        """
+        Get the file of a cached mask, spread over subdirectories by key prefix
+        """
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        """
+        Get a cached mask
+
+        Args:
+            key (string): key of the result
+
+        Returns:
+            ndarray of uint8 with 255 for foreground, or None if not cached
+        """
+        path = self.path(key)
+        try:
+            mask = read_mask_npz(path)
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        # mark as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if self.index is not None and path in self.index:
+            self.index[path] = (self.index[path][0], time.time())
+
+        self.hits += 1
+
+        return mask
+
+    def put(self, key, mask):
+        """
+        Cache a mask
+
+        Args:
+            key (string): key of the result
+            mask (ndarray): mask with nonzero foreground
+
+        Returns:
+            nothing
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.index is None:
+            self.load_index()
+
+        # write then rename, so concurrent runs never read half a mask
+        temp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+        write_mask_npz(temp_path, mask)
+        os.replace(temp_path, path)
+
+        # a mask replaced if the key is cached already is no longer counted
+        replaced_size = self.index.get(path, (0, 0))[0]
+        size = os.path.getsize(path)
+        self.index[path] = (size, time.time())
+        self.size += size - replaced_size
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """
+        List cached masks
+
+        Returns:
+            list of (path, size, last used time) tuples
+        """
+        entries = []
+        for folder, _, files in os.walk(self.directory):
+            for file in files:
+                if not file.endswith('.npz') or '.tmp.' in file:
+                    continue
+                path = os.path.join(folder, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def load_index(self):
+        """
+        Scan the cached masks into the index
+
+        Returns:
+            nothing
+        """
+        self.index = {path: (size, used) for path, size, used in self.entries()}
+        self.size = sum(size for size, _ in self.index.values())
+
+    def evict(self):
+        """
+        Remove least recently used masks until the cache is down to
+        LOW_WATER_RATIO of its size limit
+
+        Returns:
+            nothing
+        """
+        if self.index is None:
+            self.load_index()
+
+        low_water = LOW_WATER_RATIO * self.max_bytes
+        for path in sorted(self.index, key=lambda path: self.index[path][1]):
+            if self.size <= low_water:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another run sharing the cache
+                pass
+            self.size -= self.index.pop(path)[0]
@@ -0,0 +1,191 @@
+import json
+import time
+import tracemalloc
+
+
+# name prefix of exported prometheus metrics
+PROMETHEUS_PREFIX = 'leaf_segmentation_stage'
+
+
+class Stage:
+    """
+    Context manager timing one run of a pipeline stage into Metrics
+    """
+
+    def __init__(self, metrics, name, pixels):
+        self.metrics = metrics
+        self.name = name
+        self.pixels = pixels
+
+    def __enter__(self):
+        self.traced = tracemalloc.is_tracing()
+        if self.traced:
+            tracemalloc.reset_peak()
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        allocated = None
+        if self.traced:
+            allocated = tracemalloc.get_traced_memory()[1] - self.start_memory
+
+        self.metrics.records.append({
+            'label': self.metrics.label,
+            'stage': self.name,
+            'seconds': seconds,
+            'pixels': self.pixels,
+            'allocated_bytes': allocated,
+        })
+
+
+class NullStage:
+    """
+    Context manager doing nothing, stage of disabled metrics
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Metrics:
+    """
+    Records wall time, pixel count and allocated bytes of pipeline stages
+
+    Allocated bytes are the peak memory traced by tracemalloc during a stage,
+    they are recorded only while tracemalloc is tracing
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        """
+        Args:
+            trace_memory (boolean): start tracemalloc to record allocated bytes
+        """
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        # label of records, e.g image file being processed
+        self.label = None
+        self.records = []
+
+    def stage(self, name, pixels=0):
+        """
+        Time a stage of the pipeline
+
+        Args:
+            name (string): name of the stage
+            pixels (int): number of pixels the stage processes
+
+        Returns:
+            context manager recording the stage when it exits
+        """
+        return Stage(self, name, pixels)
+
+    def drain(self):
+        """
+        Take away records collected so far
+
+        Returns:
+            list of records, see write_jsonl
+        """
+        records, self.records = self.records, []
+
+        return records
+
+    def summary(self):
+        """
+        Aggregate records by stage
+
+        Returns:
+            dict of stage name to dict of calls, seconds, pixels and
+            max allocated_bytes (None when not traced)
+        """
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(record['stage'], {
+                'calls': 0, 'seconds': 0.0, 'pixels': 0, 'allocated_bytes': None,
+            })
+            stage['calls'] += 1
+            stage['seconds'] += record['seconds']
+            stage['pixels'] += record['pixels']
+            if record['allocated_bytes'] is not None:
+                stage['allocated_bytes'] = max(stage['allocated_bytes'] or 0,
+                                               record['allocated_bytes'])
+
+        return stages
+
+    def write_jsonl(self, file):
+        """
+        Write every record as a line of JSON
+
+        Records have label, stage, seconds, pixels and allocated_bytes
+
+        Args:
+            file (string): path of the file to write
+
+        Returns:
+            nothing
+        """
+        with open(file, 'w') as output:
+            for record in self.records:
+                output.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self, file):
+        """
+        Write records aggregated by stage in prometheus text format
+
+        Args:
+            file (string): path of the file to write
+
+        Returns:
+            nothing
+        """
+        summary = self.summary()
+        lines = []
+
+        def add(metric, kind, description, key):
+            name = '{}_{}'.format(PROMETHEUS_PREFIX, metric)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for stage, values in sorted(summary.items()):
+                if values[key] is not None:
+                    lines.append('{}{{stage="{}"}} {}'.format(name, stage, values[key]))
+
+        add('calls_total', 'counter', 'Number of runs of a pipeline stage', 'calls')
+        add('seconds_total', 'counter', 'Wall time spent in a pipeline stage', 'seconds')
+        add('pixels_total', 'counter', 'Pixels processed by a pipeline stage', 'pixels')
+        add('allocated_bytes_max', 'gauge',
+            'Peak bytes allocated during a run of a pipeline stage', 'allocated_bytes')
+
+        with open(file, 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+
+
+class NullMetrics:
+    """
+    Metrics that record nothing, used when instrumentation is disabled
+    """
+
+    enabled = False
+    label = None
+    records = ()
+
+    def __init__(self):
+        self.null_stage = NullStage()
+
+    def stage(self, name, pixels=0):
+        return self.null_stage
+
+    def drain(self):
+        return []
+
+
+# shared instance of disabled metrics
+NO_METRICS = NullMetrics()
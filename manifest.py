@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import sqlite3
+
+
+# file name of the manifest in the destination folder of a run
+MANIFEST_FILE = '.segment_manifest.sqlite'
+
+# statuses of files in the manifest
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Manifest:
+    """
+    Record of the image files a run segmented, kept in its destination folder
+
+    Every file is recorded with its size, modification time, the parameters
+    it was segmented with, its output and whether it was segmented, so that
+    a run restarted after dying halfway skips files already done and tries
+    failed ones again. Records are committed one by one in write ahead log
+    mode, only the process running the command records, so an interrupted
+    run loses at most the file it was writing
+    """
+
+    def __init__(self, destination, timeout=30):
+        """
+        Args:
+            destination (string): destination folder of the run
+            timeout (float): seconds to wait for another run writing the manifest
+        """
+        self.path = os.path.join(destination, MANIFEST_FILE)
+        self.connection = sqlite3.connect(self.path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'input TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, params TEXT, '
+                'output TEXT, status TEXT, error TEXT, updated REAL)')
+
+        # records of earlier runs by input path, loaded once so lookups take O(1)
+        self.records = {
+            row[0]: row[1:]
+            for row in self.connection.execute(
+                'SELECT input, size, mtime_ns, params, output, status FROM files')
+        }
+        # size and modification time of files handed out by pending, until recorded
+        self.stats = {}
+        self.skipped = 0
+
+    def is_done(self, path, stat, params):
+        """
+        Check if a file was segmented as it is now with the same parameters
+
+        Args:
+            path (string): absolute path of the image file
+            stat (os.stat_result): stat of the image file
+            params (string): parameters of the run, see params_string
+
+        Returns:
+            True if the file is recorded done, unchanged since, and its output exists
+        """
+        record = self.records.get(path)
+        if record is None:
+            return False
+
+        size, mtime_ns, record_params, output, status = record
+
+        return status == DONE and size == stat.st_size and mtime_ns == stat.st_mtime_ns \
+            and record_params == params and os.path.exists(output)
+
+    def pending(self, files, base_folder, params):
+        """
+        Filter out files already done
+
+        Args:
+            files (iterable of strings): filenames relative to base_folder
+            base_folder (string): folder of the files
+            params (string): parameters of the run, see params_string
+
+        Returns:
+            generator of files not done yet, failed ones included
+        """
+        for file in files:
+            path = os.path.abspath(os.path.join(base_folder, file))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # left for segmenting to report
+                yield file
+                continue
+
+            if self.is_done(path, stat, params):
+                self.skipped += 1
+                continue
+
+            self.stats[path] = (stat.st_size, stat.st_mtime_ns)
+            yield file
+
+    def record(self, file, base_folder, params, output, error=None):
+        """
+        Record a file handed out by pending as segmented or failed
+
+        Args:
+            file (string): filename relative to base_folder
+            base_folder (string): folder of the file
+            params (string): parameters of the run, see params_string
+            output (string): path of the output file
+            error (string or None): error code if file couldn't be segmented
+
+        Returns:
+            nothing
+        """
+        path = os.path.abspath(os.path.join(base_folder, file))
+        size, mtime_ns = self.stats.pop(path, (None, None))
+        status = DONE if error is None else FAILED
+        output = os.path.abspath(output)
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, params, output, status, error, time.time()))
+        self.records[path] = (size, mtime_ns, params, output, status)
+
+    def close(self):
+        """
+        Close the manifest
+
+        Returns:
+            nothing
+        """
+        self.connection.close()
+
+
+def params_string(params):
+    """
+    Serialize the parameters outputs depend on, to compare them between runs
+
+    Args:
+        params (dict): parameters of json serializable values
+
+    Returns:
+        string of params with sorted keys
+    """
+    return json.dumps(params, sort_keys=True)
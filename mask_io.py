@@ -0,0 +1,251 @@
+import os
+import json
+import numpy as np
+import cv2
+
+from utils import IMAGE_NOT_READ
+
+
+# file extension of the formats masks can be written in, image keeps
+# the extension of the segmented image
+MASK_FORMATS = {
+    'image': None,
+    'png': '.png',
+    'rle': '.json',
+    'coco': '.json',
+    'npz': '.npz',
+}
+
+
+def rle_counts(mask):
+    """
+    Count runs of background and foreground of a mask in column major order
+
+    Args:
+        mask (ndarray): mask with nonzero foreground
+
+    Returns:
+        list of run lengths, starting with background so it may start with 0
+    """
+    flat = mask.ravel(order='F') != 0
+    if not len(flat):
+        return []
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [len(flat)])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+
+    return counts.tolist()
+
+
+def compress_counts(counts):
+    """
+    Compress run lengths into a string the way COCO does
+
+    Every count but the first three is stored as the difference to the
+    count two runs before, in 5 bit groups of ascii characters
+
+    Args:
+        counts (list): run lengths, see rle_counts
+
+    Returns:
+        string of compressed counts
+    """
+    chars = []
+    for index, count in enumerate(counts):
+        if index > 2:
+            count -= counts[index - 2]
+        more = True
+        while more:
+            char = count & 0x1f
+            count >>= 5
+            more = count != -1 if char & 0x10 else count != 0
+            if more:
+                char |= 0x20
+            chars.append(chr(char + 48))
+
+    return ''.join(chars)
+
+
+def decompress_counts(string):
+    """
+    Decompress run lengths compressed by compress_counts
+
+    Args:
+        string (string): compressed counts
+
+    Returns:
+        list of run lengths
+    """
+    counts = []
+    position = 0
+    while position < len(string):
+        count = shift = 0
+        more = True
+        while more:
+            char = ord(string[position]) - 48
+            count |= (char & 0x1f) << shift
+            more = char & 0x20
+            position += 1
+            shift += 5
+            if not more and char & 0x10:
+                count |= -1 << shift
+        if len(counts) > 2:
+            count += counts[-2]
+        counts.append(count)
+
+    return counts
+
+
+def encode_rle(mask, compress=False):
+    """
+    Encode a mask with run length encoding as COCO does
+
+    Args:
+        mask (ndarray): mask with nonzero foreground
+        compress (boolean): compress the counts into a string as COCO RLE,
+                            keep them a list of integers otherwise
+
+    Returns:
+        dict of size as [height, width] and counts
+    """
+    counts = rle_counts(mask)
+
+    return {
+        'size': [mask.shape[0], mask.shape[1]],
+        'counts': compress_counts(counts) if compress else counts,
+    }
+
+
+def decode_rle(rle):
+    """
+    Decode a mask encoded by encode_rle, or by COCO
+
+    Args:
+        rle (dict): size and counts, compressed or not
+
+    Returns:
+        ndarray of uint8 with 255 for foreground
+    """
+    height, width = rle['size']
+    counts = rle['counts']
+    if isinstance(counts, str):
+        counts = decompress_counts(counts)
+
+    values = np.arange(len(counts), dtype=np.uint8) % 2 * np.uint8(255)
+    flat = np.repeat(values, counts)
+
+    return flat.reshape((width, height)).T.copy()
+
+
+def write_mask_npz(file, mask):
+    """
+    Write a mask bit packed into a .npz file, with its shape to unpack it
+
+    Args:
+        file (string): path of the file
+        mask (ndarray): mask with nonzero foreground
+
+    Returns:
+        nothing
+    """
+    np.savez(file, bits=np.packbits(mask != 0), shape=np.array(mask.shape))
+
+
+def read_mask_npz(file):
+    """
+    Read a mask written by write_mask_npz
+
+    Args:
+        file (string): path of the file
+
+    Returns:
+        ndarray of uint8 with 255 for foreground
+
+    Raises:
+        OSError, KeyError or ValueError if the file is missing or is not a mask
+    """
+    with np.load(file) as packed:
+        bits, shape = packed['bits'], tuple(packed['shape'])
+
+    mask = np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape)
+
+    return mask * np.uint8(255)
+
+
+def mask_filename(file, mask_format):
+    """
+    Get the filename of a mask in a format
+
+    Args:
+        file (string): filename of the segmented image
+        mask_format (string in MASK_FORMATS): format of the mask
+
+    Returns:
+        file with the extension of the format
+    """
+    extension = MASK_FORMATS[mask_format]
+    if extension is None:
+        return file
+
+    return os.path.splitext(file)[0] + extension
+
+
+def write_mask(file, mask, mask_format):
+    """
+    Write a binary mask in a compact format
+
+    Args:
+        file (string): path of the file, see mask_filename
+        mask (ndarray): mask with nonzero foreground
+        mask_format (string in MASK_FORMATS):
+            - image: grayscale image in the format of the file extension
+            - png: 1 bit per pixel png
+            - rle: uncompressed COCO run length encoding as JSON
+            - coco: compressed COCO run length encoding as JSON
+            - npz: bit packed array with its shape
+
+    Returns:
+        nothing
+    """
+    if mask_format == 'npz':
+        write_mask_npz(file, mask)
+    elif mask_format in ('rle', 'coco'):
+        with open(file, 'w') as output:
+            json.dump(encode_rle(mask, compress=mask_format == 'coco'), output)
+    else:
+        # nonzero foreground becomes white, 1 bit deep for png
+        white = cv2.threshold(mask, 0, 255, cv2.THRESH_BINARY)[1]
+        params = [cv2.IMWRITE_PNG_BILEVEL, 1] if mask_format == 'png' else []
+        cv2.imwrite(file, white, params)
+
+
+def read_mask(file):
+    """
+    Read a mask written by write_mask, format is told by the file extension
+
+    Args:
+        file (string): path of the file
+
+    Returns:
+        ndarray of uint8 with 255 for foreground
+
+    Raises:
+        ValueError if mask could not be read with message IMAGE_NOT_READ
+    """
+    extension = os.path.splitext(file)[1].lower()
+    try:
+        if extension == '.npz':
+            return read_mask_npz(file)
+        if extension == '.json':
+            with open(file) as rle_file:
+                return decode_rle(json.load(rle_file))
+    except (OSError, KeyError, ValueError):
+        raise ValueError(IMAGE_NOT_READ)
+
+    mask = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(IMAGE_NOT_READ)
+
+    return cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
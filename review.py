@@ -1,23 +1,20 @@
-from matplotlib import pyplot as plt
-
 from utils import *
 from otsu_segmentation import *
 
 files = {
-    "jpg1": "testing_files/apple_healthy.jpg",
-    "jpg2": "testing_files/apple_healthy_marked.jpg",
-    "jpg3": "testing_files/jpg3.jpg",
-    "jpg4": "testing_files/jpg4.jpg",
-    "jpg5": "testing_files/jpg5.jpg",
-    "jpg6": "testing_files/jpg6.jpg",
-    "jpg7": "testing_files/jpg7.jpg",
-    "jpg8": "testing_files/jpg8.jpg",
+    "jpg1": "testing_files/apple_healthy.JPG",
+    "jpg2": "testing_files/apple_healthy_marked.JPG",
+    "jpg3": "testing_files/apple_black_rot.JPG",
+    "jpg4": "testing_files/apple_black_rot_marked.JPG",
 }
 
 from background_marker import *
 
 
 def show_review(original_image, image, image_title, hist_val=None, gray=False):
+    # matplotlib takes longer to import than segmenting an image, only reviews need it
+    from matplotlib import pyplot as plt
+
     if hist_val is None:
         plot_nums = 2
     else:
@@ -1,42 +1,443 @@
 import os
+import time
 import argparse
 import numpy as np
 import cv2
 
 from utils import *
 from background_marker import *
+from instrumentation import NO_METRICS
+from mask_io import MASK_FORMATS, mask_filename, write_mask
+from otsu_segmentation import otsu_marker
 
 
-def generate_background_marker(file):
+# version of the segmentation algorithm, bump it when results change
+# so that cached results are not reused
+ALGORITHM_VERSION = 2
+
+# engines generating the marker of leaf pixels, by vegetation color index
+# rules or by otsu thresholding of the grayscale image
+ENGINES = ('color_index', 'otsu')
+
+
+def read_image_file(file, decode_scale=1):
     """
-    Generate background marker for an image
+    Read an image file to be segmented
 
     Args:
         file (string): full path of an image file
+        decode_scale (int in DECODE_SCALES): factor to reduce width and height by while decoding
 
     Returns:
-        tuple[0] (ndarray of an image): original image
-        tuple[1] (ndarray size of an image): background marker
+        ndarray of the read image
+
+    Raises:
+        ValueError if file is not a file or could not be read
     """
 
     # check file name validity
     if not os.path.isfile(file):
         raise ValueError('{}: is not a file'.format(file))
 
-    original_image = read_image(file)
+    return read_image(file, decode_scale=decode_scale)
+
+
+def read_image_bytes(file):
+    """
+    Read the content of an image file to be segmented without decoding it
+
+    Args:
+        file (string): full path of an image file
+
+    Returns:
+        bytes of the file
+
+    Raises:
+        ValueError if file is not a file
+    """
+
+    # check file name validity
+    if not os.path.isfile(file):
+        raise ValueError('{}: is not a file'.format(file))
 
-    marker = np.full((original_image.shape[0], original_image.shape[1]), True)
+    with open(file, 'rb') as image_file:
+        return image_file.read()
 
-    # update marker based on vegetation color index technique
-    color_index_marker(index_diff(original_image), marker)
+
+def image_marker(original_image, use_lut=False, marker=None, engine='color_index'):
+    """
+    Generate background marker for an image already read
+
+    Args:
+        original_image (ndarray): bgr image
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+        marker (ndarray of booleans or None): buffer size of the image to generate
+                                              the marker in, allocated if None
+        engine (string in ENGINES): how the marker is generated, use_lut
+                                    applies to color_index only
+
+    Returns:
+        ndarray size of an image: background marker
+    """
+
+    if engine == 'otsu':
+        return otsu_marker(original_image, marker)
+
+    if marker is None:
+        marker = np.full((original_image.shape[0], original_image.shape[1]), True)
+    else:
+        marker.fill(True)
+
+    if use_lut:
+        # same rules as below, compiled into one lookup of each pixel's color
+        lut_marker(original_image, marker, load_marker_lut())
+    else:
+        # update marker based on vegetation color index technique
+        color_index_marker(index_diff(original_image), marker)
 
     # update marker to remove blues
     # remove_blues(original_image, marker)
 
-    return original_image, marker
+    return marker
+
+
+def generate_background_marker(file, use_lut=False, decode_scale=1):
+    """
+    Generate background marker for an image
+
+    Args:
+        file (string): full path of an image file
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+        decode_scale (int in DECODE_SCALES): factor to reduce width and height by while decoding
+
+    Returns:
+        tuple[0] (ndarray of an image): original image, reduced by decode_scale
+        tuple[1] (ndarray size of an image): background marker
+    """
+
+    original_image = read_image_file(file, decode_scale)
+
+    return original_image, image_marker(original_image, use_lut)
+
+
+def leaf_mask(original, filling_mode, smooth_boundary, use_lut=False, coarse_scale=1,
+              marker=None, metrics=NO_METRICS, engine='color_index'):
+    """
+    Generate a mask of the leaf in an image already read
+
+    Args:
+        original (ndarray): bgr image to be segmented
+        filling_mode (string {no, flood, threshold, morph}):
+            how holes should be filled in segmented leaf
+        smooth_boundary (boolean): should leaf boundary smoothed or not
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+        coarse_scale (int): if greater than 1 find the leaf on an image downscaled
+                            by this factor, see coarse_leaf_mask
+        marker (ndarray of booleans or None): workspace for the marker, allocated if None,
+                                              it is overwritten by the binary image
+        metrics (Metrics): metrics recording the stages, records nothing by default
+        engine (string in ENGINES): how the marker is generated
+
+    Returns:
+        ndarray: mask with nonzero values where leaf is in the image
+
+    Raises:
+        ValueError if engine is otsu and coarse_scale is greater than 1
+    """
+    if coarse_scale > 1:
+        if engine != 'color_index':
+            raise ValueError('{} engine can not segment coarse to fine'.format(engine))
+        return coarse_leaf_mask(original, filling_mode, smooth_boundary,
+                                use_lut, coarse_scale, metrics)
+
+    with metrics.stage(engine, original.shape[0] * original.shape[1]):
+        marker = image_marker(original, use_lut, marker, engine)
+
+        # set up binary image for futher processing, the marker's
+        # own buffer is turned into it without a copy
+        bin_image = marker.view(np.uint8)
+        bin_image *= np.uint8(255)
+
+    # further processing of image, filling holes, smoothing edges
+    return select_largest_obj(bin_image, fill_mode=filling_mode,
+                              smooth_boundary=smooth_boundary, metrics=metrics)
+
+
+def coarse_leaf_mask(original, filling_mode, smooth_boundary, use_lut, scale,
+                     metrics=NO_METRICS):
+    """
+    Generate a mask of the leaf coarse to fine
+
+    The largest object is selected and its holes filled on a downscaled image,
+    the mask is upscaled, then only a band around its boundary is decided again
+    with the color index at full resolution
+
+    Args:
+        original (ndarray): bgr image to be segmented
+        filling_mode, smooth_boundary, use_lut, metrics: see leaf_mask
+        scale (int): factor to downscale the image by
+
+    Returns:
+        ndarray: mask with 255 where leaf is in the image
+    """
+    height, width = original.shape[0], original.shape[1]
+    with metrics.stage('color_index', height * width):
+        small = cv2.resize(original, (max(1, width // scale), max(1, height // scale)),
+                           interpolation=cv2.INTER_AREA)
+        marker = image_marker(small, use_lut)
+        bin_image = marker.view(np.uint8)
+        bin_image *= np.uint8(255)
+
+    # kernels are sized for full resolution images
+    small_mask = select_largest_obj(bin_image, fill_mode=filling_mode,
+                                    smooth_boundary=smooth_boundary,
+                                    kernel_size=max(1, 15 // scale),
+                                    closing_size=max(1, 50 // scale),
+                                    metrics=metrics)
+
+    with metrics.stage('refine', height * width):
+        mask = cv2.resize(small_mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        mask[mask != 0] = 255
+
+        # band of a coarse pixel around the upscaled boundary
+        kernel_ = np.ones((2 * scale + 1, 2 * scale + 1), dtype=np.uint8)
+        band = cv2.dilate(mask, kernel_) != cv2.erode(mask, kernel_)
+
+        # decide the band on its own pixels at full resolution
+        band_marker = image_marker(original[band][np.newaxis], use_lut)[0]
+        mask[band] = band_marker * np.uint8(255)
+
+    return mask
+
+
+def upscale_mask(mask, size):
+    """
+    Resize a leaf mask found on an image decoded reduced back to the image's full size
+
+    Args:
+        mask (ndarray): mask with nonzero values where leaf is
+        size (tuple): height and width at full size
+
+    Returns:
+        ndarray: mask of size, nearest neighbor of mask
+    """
+    if mask.shape[:2] == tuple(size):
+        return mask
+
+    return cv2.resize(mask, (size[1], size[0]), interpolation=cv2.INTER_NEAREST)
+
+
+def decode_scale_params(params, decode_scale):
+    """
+    Add the decode scale to the parameters cached results depend on
+
+    Args:
+        params (dict): see Segmenter.cache_params
+        decode_scale (int in DECODE_SCALES): factor images are reduced by while decoding
+
+    Returns:
+        dict of params, with decode_scale if images are reduced so that
+        keys of results at full scale stay the same
+    """
+    if decode_scale == 1:
+        return params
+
+    return dict(params, decode_scale=decode_scale)
+
 
+class Segmenter:
+    """
+    Segments leaves from images already read, with settings configured once
+
+    Workspace buffers are kept between calls and reused as long as images
+    keep the same shape, so a long lived segmenter allocates less per image
+    """
 
-def segment_leaf(image_file, filling_mode, smooth_boundary, marker_intensity):
+    def __init__(self, filling_mode=FILL['FLOOD'], smooth_boundary=False,
+                 marker_intensity=0, use_lut=False, coarse_scale=1, metrics=None,
+                 engine='color_index'):
+        """
+        Args:
+            filling_mode (string {no, flood, threshold, morph}):
+                how holes should be filled in segmented leaf
+            smooth_boundary (boolean): should leaf boundary smoothed or not
+            marker_intensity (int in rgb_range): should output background marker based
+                                                 on this intensity value as foreground value
+            use_lut (boolean): mark colors with a compiled lookup table of the rules
+            coarse_scale (int): if greater than 1 segment coarse to fine from an image
+                                downscaled by this factor
+            metrics (Metrics or None): metrics recording the stages, None to not record
+            engine (string in ENGINES): how the marker of leaf pixels is generated
+        """
+        self.filling_mode = filling_mode
+        self.smooth_boundary = smooth_boundary
+        self.marker_intensity = marker_intensity
+        self.use_lut = use_lut
+        self.coarse_scale = coarse_scale
+        self.metrics = NO_METRICS if metrics is None else metrics
+        self.engine = engine
+
+        if use_lut and engine == 'color_index':
+            # compile or load the table now rather than on the first image
+            load_marker_lut()
+
+        self.marker = None
+
+    def cache_params(self):
+        """
+        Get parameters the leaf mask depends on, for keys of cached results
+
+        Returns:
+            dict of algorithm version and mask settings, with the engine
+            if it is not color_index so that keys of earlier results stay the same
+        """
+        params = {
+            'version': ALGORITHM_VERSION,
+            'filling_mode': self.filling_mode,
+            'smooth_boundary': self.smooth_boundary,
+            'coarse_scale': self.coarse_scale,
+        }
+        if self.engine != 'color_index':
+            params['engine'] = self.engine
+
+        return params
+
+    def workspace(self, shape):
+        """
+        Get the marker buffer for images of a shape
+
+        Args:
+            shape (tuple): height and width of the image
+
+        Returns:
+            ndarray of booleans: marker buffer, also holds the binary image
+        """
+        if self.marker is None or self.marker.shape != shape:
+            self.marker = np.empty(shape, dtype=bool)
+
+        return self.marker
+
+    def mask(self, image):
+        """
+        Generate a mask of the leaf in an image
+
+        Args:
+            image (ndarray): bgr image
+
+        Returns:
+            ndarray: mask with nonzero values where leaf is in the image
+        """
+        ensure_color(image)
+        marker = self.workspace(image.shape[:2])
+
+        return leaf_mask(image, self.filling_mode, self.smooth_boundary,
+                         self.use_lut, self.coarse_scale, marker, self.metrics, self.engine)
+
+    def output(self, image, largest_mask, out=None):
+        """
+        Generate output of segmentation from a leaf mask
+
+        Args:
+            image (ndarray): bgr image that was segmented
+            largest_mask (ndarray): mask of the leaf, it is overwritten
+                                    with the output if out is None
+            out (ndarray or None): array to write the output into, shaped as
+                                   the mask if marker_intensity is set otherwise as image,
+                                   image itself to segment it in place, which
+                                   overwrites largest_mask as well
+
+        Returns:
+            ndarray: A mask to indicate where leaf is in the image
+                     or the segmented image based on marker_intensity value
+        """
+        with self.metrics.stage('output', largest_mask.shape[0] * largest_mask.shape[1]):
+            if self.marker_intensity > 0:
+                if out is None:
+                    out = largest_mask
+                cv2.threshold(largest_mask, 0, self.marker_intensity, cv2.THRESH_BINARY,
+                              dst=out)
+            else:
+                # apply marker to original image, masked pixels are left untouched
+                if out is image:
+                    # zero the background by multiplying with the mask as 0 or 1
+                    cv2.threshold(largest_mask, 0, 1, cv2.THRESH_BINARY, dst=largest_mask)
+                    np.multiply(image, largest_mask[:, :, np.newaxis], out=image)
+                else:
+                    if out is None:
+                        out = np.zeros_like(image)
+                    else:
+                        out.fill(0)
+                    cv2.bitwise_and(image, image, dst=out, mask=largest_mask)
+
+        return out
+
+    def segment(self, image, out=None):
+        """
+        Segment leaf from an image
+
+        Args:
+            image (ndarray): bgr image
+            out (ndarray or None): array to write the output into, see output
+
+        Returns:
+            ndarray: A mask to indicate where leaf is in the image
+                     or the segmented image based on marker_intensity value
+        """
+        return self.output(image, self.mask(image), out)
+
+
+def segment_image(original, filling_mode, smooth_boundary, marker_intensity,
+                  use_lut=False, coarse_scale=1, in_place=False, engine='color_index'):
+    """
+    Segments leaf from an image already read, see segment_leaf
+
+    Args:
+        original (ndarray): bgr image to be segmented
+        in_place (boolean): write the segmented image into original rather than
+                            a new array, when marker_intensity is not set
+        engine (string in ENGINES): how the marker of leaf pixels is generated
+
+    Returns:
+        ndarray: A mask to indicate where leaf is in the image
+                 or the segmented image based on marker_intensity value
+    """
+    segmenter = Segmenter(filling_mode, smooth_boundary, marker_intensity,
+                          use_lut, coarse_scale, engine=engine)
+
+    out = original if in_place and marker_intensity == 0 else None
+    return segmenter.segment(original, out)
+
+
+def segment_images(images, filling_mode, smooth_boundary, marker_intensity,
+                   use_lut=False, coarse_scale=1, engine='color_index', jobs=1):
+    """
+    Segments leaves from images already read, see segment_leaf
+
+    Args:
+        images (iterable of ndarrays): bgr images to be segmented
+        jobs (int): number of processes segmenting images in parallel, images
+                    and outputs are passed through shared memory, see SharedMemoryPool
+
+    Returns:
+        generator of outputs in order of images, see segment_image
+    """
+    if jobs <= 1:
+        segmenter = Segmenter(filling_mode, smooth_boundary, marker_intensity,
+                              use_lut, coarse_scale, engine=engine)
+        for image in images:
+            yield segmenter.segment(image)
+        return
+
+    # imported here, shm_pool imports this module for its workers
+    from shm_pool import SharedMemoryPool
+    with SharedMemoryPool(filling_mode, smooth_boundary, marker_intensity, use_lut,
+                          coarse_scale, engine, jobs) as pool:
+        yield from pool.segment(images)
+
+
+def segment_leaf(image_file, filling_mode, smooth_boundary, marker_intensity,
+                 use_lut=False, coarse_scale=1, metrics=None, cache=None,
+                 decode_scale=1, upscale=False, engine='color_index'):
     """
     Segments leaf from an image file
 
@@ -47,34 +448,59 @@ def segment_leaf(image_file, filling_mode, smooth_boundary, marker_intensity):
         smooth_boundary (boolean): should leaf boundary smoothed or not
         marker_intensity (int in rgb_range): should output background marker based
                                              on this intensity value as foreground value
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+        coarse_scale (int): if greater than 1 segment coarse to fine from an image
+                            downscaled by this factor
+        metrics (Metrics or None): metrics recording time, pixels and allocated
+                                   bytes of every stage, None to not record
+        cache (ResultCache or None): cache of leaf masks keyed by image content,
+                                     None to always segment
+        decode_scale (int in DECODE_SCALES): segment the image decoded reduced by this factor,
+                                             jpeg images decode several times faster
+        upscale (boolean): resize the leaf mask back to the full size of the image,
+                           the original image is then decoded again at full size
+                           if the output is the segmented image
+        engine (string in ENGINES): how the marker of leaf pixels is generated
 
     Returns:
-        tuple[0] (ndarray): original image to be segmented
+        tuple[0] (ndarray): original image to be segmented, reduced by decode_scale
+                            unless decoded again at full size
         tuple[1] (ndarray): A mask to indicate where leaf is in the image
                             or the segmented image based on marker_intensity value
     """
-    # get background marker and original image
-    original, marker = generate_background_marker(image_file)
+    segmenter = Segmenter(filling_mode, smooth_boundary, marker_intensity,
+                          use_lut, coarse_scale, metrics, engine)
 
-    # set up binary image for futher processing
-    bin_image = np.zeros((original.shape[0], original.shape[1]))
-    bin_image[marker] = 255
-    bin_image = bin_image.astype(np.uint8)
+    if cache is None and not upscale:
+        with segmenter.metrics.stage('decode') as stage:
+            original = read_image_file(image_file, decode_scale)
+            stage.pixels = original.shape[0] * original.shape[1]
 
-    # further processing of image, filling holes, smoothing edges
-    largest_mask = \
-        select_largest_obj(bin_image, fill_mode=filling_mode,
-                           smooth_boundary=smooth_boundary)
+        return original, segmenter.segment(original)
 
-    if marker_intensity > 0:
-        largest_mask[largest_mask != 0] = marker_intensity
-        image = largest_mask
-    else:
-        # apply marker to original image
-        image = original.copy()
-        image[largest_mask == 0] = np.array([0, 0, 0])
+    data = read_image_bytes(image_file)
+    with segmenter.metrics.stage('decode') as stage:
+        original = decode_image(data, decode_scale=decode_scale)
+        stage.pixels = original.shape[0] * original.shape[1]
+
+    largest_mask = None
+    if cache is not None:
+        key = cache.key(data, decode_scale_params(segmenter.cache_params(), decode_scale))
+        largest_mask = cache.get(key)
+    if largest_mask is None:
+        largest_mask = segmenter.mask(original)
+        if cache is not None:
+            cache.put(key, largest_mask)
 
-    return original, image
+    if upscale and decode_scale > 1:
+        largest_mask = upscale_mask(largest_mask,
+                                    original_size(data, original.shape, decode_scale))
+        if marker_intensity == 0:
+            with segmenter.metrics.stage('decode') as stage:
+                original = decode_image(data)
+                stage.pixels = original.shape[0] * original.shape[1]
+
+    return original, segmenter.output(original, largest_mask)
 
 
 def rgb_range(arg):
@@ -103,6 +529,98 @@ def rgb_range(arg):
     return value
 
 
+def shard_spec(arg):
+    """
+    Check if arg is a shard of a dataset as index/count
+
+    Args:
+        arg (string): shard such as 0/4 for the first of 4 shards
+
+    Returns:
+        tuple of index and count in int form if valid
+
+    Raises:
+        argparse.ArgumentTypeError: if value is not two integers or index is not below count
+    """
+
+    try:
+        index, count = (int(value) for value in arg.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected index/count, got {}'.format(arg))
+
+    if count < 1 or index < 0 or index >= count:
+        message = "Expected 0 <= index < count, got {}".format(arg)
+        raise argparse.ArgumentTypeError(message)
+
+    return index, count
+
+
+def output_filename(file, destination, with_original, mask_format='image'):
+    """
+    Get the output filename of a segmented image file
+
+    Args:
+        file (string): filename of the input image, relative to its folder,
+                       subfolders of it are mirrored in destination
+        destination (string): destination folder of the output
+        with_original (boolean): output is appended to the original image
+        mask_format (string in MASK_FORMATS): format the mask is written in
+
+    Returns:
+        full path of the output image file
+    """
+    filename, ext = os.path.splitext(file)
+    if with_original:
+        new_filename = filename + '_marked_merged' + ext
+    else:
+        new_filename = filename + '_marked' + ext
+
+    return os.path.join(destination, mask_filename(new_filename, mask_format))
+
+
+def write_segmented(new_filename, original, output_image, marker_intensity, with_original,
+                    mask_format='image'):
+    """
+    Write output of segment_leaf to an image file
+
+    Args:
+        new_filename (string): full path of the output image file
+        original (ndarray): original image returned by segment_leaf
+        output_image (ndarray): segmented image or mask returned by segment_leaf
+        marker_intensity (int in rgb_range): marker intensity segment_leaf was called with
+        with_original (boolean): append output horizontally to the original image
+        mask_format (string in MASK_FORMATS): format to write a mask in, other than
+                                              image the mask is written as is
+
+    Returns:
+        nothing
+    """
+    # subfolders of recursively scanned folders are mirrored
+    os.makedirs(os.path.dirname(new_filename) or '.', exist_ok=True)
+
+    # write then rename, so an interrupted run never leaves half an output,
+    # the extension is kept last as it tells the format
+    root, ext = os.path.splitext(new_filename)
+    temp_filename = '{}.{}.tmp{}'.format(root, os.getpid(), ext)
+
+    if mask_format != 'image':
+        write_mask(temp_filename, output_image, mask_format)
+    else:
+        # change grayscale image to color image format i.e need 3 channels
+        if marker_intensity > 0:
+            output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB)
+
+        # write the output
+        if with_original:
+            cv2.imwrite(temp_filename, np.hstack((original, output_image)))
+        else:
+            cv2.imwrite(temp_filename, output_image)
+
+    # nothing is written if opencv can't encode the format
+    if os.path.exists(temp_filename):
+        os.replace(temp_filename, new_filename)
+
+
 if __name__ == '__main__':
     # handle command line arguments
     parser = argparse.ArgumentParser('segment')
@@ -119,10 +637,88 @@ if __name__ == '__main__':
                              'If not specified destination directory will be input image directory')
     parser.add_argument('-o', '--with_original', action='store_true',
                         help='Segmented output will be appended horizontally to the original image')
+    parser.add_argument('-l', '--lut', action='store_true',
+                        help='Mark colors with a lookup table of the color rules, '
+                             'compiled once and cached on disk')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes segmenting images in parallel')
+    parser.add_argument('--chunksize', type=int, default=4,
+                        help='Number of image files handed to a process at once when --jobs > 1')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Report image files as they complete rather than in input order '
+                             'when --jobs > 1')
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='Overlap reading, segmenting and writing of images on separate threads')
+    parser.add_argument('--queue_size', type=int, default=4,
+                        help='Number of images held between pipeline stages when --pipeline is set')
+    parser.add_argument('-c', '--coarse', type=int, default=1,
+                        help='Segment coarse to fine, finding the leaf on an image downscaled '
+                             'by this factor and refining its boundary at full resolution')
+    parser.add_argument('--compare_full', action='store_true',
+                        help='Also segment at full resolution and report intersection over '
+                             'union of the coarse to fine output with it, needs --coarse')
+    parser.add_argument('--metrics',
+                        help='File to export wall time, pixel count and allocated bytes '
+                             'of every pipeline stage to')
+    parser.add_argument('--metrics_format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='Format of the metrics file, a JSON line per stage run or '
+                             'prometheus text aggregated by stage')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='Record allocated bytes of stages with tracemalloc, '
+                             'slows segmentation down')
+    parser.add_argument('--cache',
+                        help='Directory of a cache of leaf masks keyed by image content and '
+                             'settings, unchanged images are not segmented again')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='Size in megabytes the cache may take, least recently used '
+                             'masks are evicted beyond it')
+    parser.add_argument('--decode_scale', type=int, choices=DECODE_SCALES, default=1,
+                        help='Decode images reduced by this factor, faster for jpeg images, '
+                             'outputs are reduced as well')
+    parser.add_argument('--upscale', action='store_true',
+                        help='Resize outputs of --decode_scale back to the full image size, '
+                             'images are decoded again at full size unless only masks are output')
+    parser.add_argument('--mask_format', choices=list(MASK_FORMATS), default='image',
+                        help='Write the leaf mask as a 1 bit png, COCO run length encoding as '
+                             'JSON, uncompressed (rle) or compressed (coco), or a bit packed '
+                             'npz rather than an image, implies mask output')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='color_index',
+                        help='Mark leaf pixels by vegetation color index rules, or by otsu '
+                             'thresholding of the grayscale image')
+    parser.add_argument('--resume', action='store_true',
+                        help='Record segmented files in a manifest in the destination directory '
+                             'and skip files it records as done with the same settings, '
+                             'so a run restarted after dying halfway retries only the rest')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Segment image files of subfolders too, mirroring them in the '
+                             'destination directory, files without an image extension are skipped')
+    parser.add_argument('--shard', type=shard_spec,
+                        help='Segment only one shard of the image files as index/count, '
+                             'such as 0/4, files are split by a hash of their paths so '
+                             'machines can split a dataset without coordinating')
+    parser.add_argument('--shared_memory', action='store_true',
+                        help='Decode and write images in this process and pass them to the '
+                             '--jobs processes through shared memory rather than having '
+                             'each process read its own files')
     parser.add_argument('image_source', help='A path of image filename or folder containing images')
     
     # set up command line arguments conveniently
     args = parser.parse_args()
+    if args.pipeline and args.jobs > 1:
+        parser.error('--pipeline can not be combined with --jobs')
+    if args.shared_memory and (args.pipeline or args.cache or args.compare_full
+                               or args.upscale):
+        parser.error('--shared_memory can not be combined with --pipeline, --cache, '
+                     '--compare_full or --upscale')
+    if args.compare_full and args.coarse == 1:
+        parser.error('--compare_full needs --coarse greater than 1')
+    if args.engine != 'color_index' and args.coarse > 1:
+        parser.error('--engine {} can not be combined with --coarse'.format(args.engine))
+    if args.mask_format != 'image':
+        if args.with_original:
+            parser.error('--mask_format can not be combined with --with_original')
+        # compact formats hold only the mask
+        args.marker_intensity = args.marker_intensity or 255
     filling_mode = FILL[args.fill.upper()]
     smooth = True if args.smooth else False
     if args.destination:
@@ -130,10 +726,12 @@ if __name__ == '__main__':
             print(args.destination, ': is not a directory')
             exit()
 
+    # imported here, batch imports this module for its workers
+    from batch import error_message, IMAGE_EXTENSIONS, run_serial, run_parallel, \
+        run_pipeline, run_shared_memory, settings_params, scan_files, shard_files
+
     # set up files to be segmented and destination place for segmented output
     if os.path.isdir(args.image_source):
-        files = [entry for entry in os.listdir(args.image_source)
-                 if os.path.isfile(os.path.join(args.image_source, entry))]
         base_folder = args.image_source
 
         # set up destination folder for segmented output
@@ -144,6 +742,10 @@ if __name__ == '__main__':
                 args.image_source = args.image_source[:-1]
             destination = args.image_source + '_markers'
             os.makedirs(destination, exist_ok=True)
+
+        # listed lazily, segmenting starts before the whole tree is scanned
+        files = scan_files(base_folder, args.recursive,
+                           IMAGE_EXTENSIONS if args.recursive else None, destination)
     else:
         folder, file = os.path.split(args.image_source)
         files = [file]
@@ -155,37 +757,90 @@ if __name__ == '__main__':
         else:
             destination = folder
 
-    for file in files:
-        try:
-            # read image and segment leaf
-            original, output_image = \
-                segment_leaf(os.path.join(base_folder, file), filling_mode, smooth, args.marker_intensity)
-
-        except ValueError as err:
-            if str(err) == IMAGE_NOT_READ:
-                print('Error: Could not read image file: ', file)
-            elif str(err) == NOT_COLOR_IMAGE:
-                print('Error: Not color image file: ', file)
-            else:
-                raise
-        # if no error when segmenting write segmented output
-        else:
-            # handle destination folder and fileaname
-            filename, ext = os.path.splitext(file)
-            if args.with_original:
-                new_filename = filename + '_marked_merged' + ext
-            else:
-                new_filename = filename + '_marked' + ext
-            new_filename = os.path.join(destination, new_filename)
-
-            # change grayscale image to color image format i.e need 3 channels
-            if args.marker_intensity > 0:
-                output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB)
-
-            # write the output
-            if args.with_original:
-                cv2.imwrite(new_filename, np.hstack((original,output_image)))
-            else:
-                cv2.imwrite(new_filename, output_image)
+    if args.shard is not None:
+        files = shard_files(files, *args.shard)
+
+    settings = {
+        'base_folder': base_folder,
+        'destination': destination,
+        'filling_mode': filling_mode,
+        'smooth_boundary': smooth,
+        'marker_intensity': args.marker_intensity,
+        'with_original': args.with_original,
+        'use_lut': args.lut,
+        'coarse_scale': args.coarse,
+        'compare_full': args.compare_full,
+        'metrics': args.metrics is not None,
+        'trace_memory': args.trace_memory,
+        'cache_dir': args.cache,
+        'cache_size': args.cache_size * 1024 * 1024,
+        'decode_scale': args.decode_scale,
+        'upscale': args.upscale,
+        'mask_format': args.mask_format,
+        'engine': args.engine,
+    }
+
+    metrics = None
+    if args.metrics is not None:
+        from instrumentation import Metrics
+        metrics = Metrics(args.trace_memory)
+
+    manifest = None
+    if args.resume:
+        from manifest import Manifest, params_string
+        manifest = Manifest(destination)
+        params = params_string(settings_params(settings))
+        files = manifest.pending(files, base_folder, params)
+
+    start_time = time.time()
+    if args.jobs > 1 and args.shared_memory:
+        results = run_shared_memory(files, settings, args.jobs, metrics=metrics)
+    elif args.jobs > 1:
+        results = run_parallel(files, settings, args.jobs, args.chunksize,
+                               ordered=not args.unordered, metrics=metrics)
+    elif args.pipeline:
+        results = run_pipeline(files, settings, args.queue_size, metrics)
+    else:
+        results = run_serial(files, settings, metrics)
+
+    segmented = failed = 0
+    ious = []
+    cache_counts = {'hit': 0, 'miss': 0}
+    for file, error, stats in results:
+        if manifest is not None:
+            manifest.record(file, base_folder, params,
+                            output_filename(file, destination, args.with_original,
+                                            args.mask_format),
+                            error)
+        if error is None:
+            segmented += 1
+            if 'cache' in stats:
+                cache_counts[stats['cache']] += 1
             print('Marker generated for image file: ', file)
-
+            if 'iou' in stats:
+                ious.append(stats['iou'])
+                print('IoU with full resolution: {:.4f}'.format(stats['iou']))
+        else:
+            failed += 1
+            print(error_message(error), file)
+
+    elapsed = time.time() - start_time
+    print('Segmented {} of {} image files in {:.2f} seconds ({:.2f} images per second)'
+          .format(segmented, segmented + failed, elapsed,
+                  segmented / elapsed if elapsed > 0 else 0.0))
+    if failed:
+        print('Failed to segment {} image files, see errors above'.format(failed))
+    if ious:
+        print('IoU with full resolution: mean {:.4f}, min {:.4f}'
+              .format(np.mean(ious), np.min(ious)))
+    if args.cache:
+        print('Cache: {} hits, {} misses'.format(cache_counts['hit'], cache_counts['miss']))
+    if manifest is not None:
+        print('Skipped {} image files already segmented'.format(manifest.skipped))
+        manifest.close()
+
+    if metrics is not None:
+        if args.metrics_format == 'prometheus':
+            metrics.write_prometheus(args.metrics)
+        else:
+            metrics.write_jsonl(args.metrics)
@@ -0,0 +1,413 @@
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from queue import Queue, Empty
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+
+from utils import IMAGE_NOT_READ, NOT_COLOR_IMAGE, NO_LEAF, decode_image
+from background_marker import FILL
+from segment import Segmenter
+from batch import error_code
+
+
+# content types of the output formats
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+}
+
+# status and message answered for images that can't be segmented, other
+# errors are answered with 500 and their message
+ERROR_RESPONSES = {
+    IMAGE_NOT_READ: (400, b'Could not read image'),
+    NOT_COLOR_IMAGE: (400, b'Not color image'),
+    NO_LEAF: (422, b'No leaf found in image'),
+}
+
+# segmenters of a pool process keyed by their settings
+worker_segmenters = {}
+
+
+def init_worker(use_lut):
+    """
+    Warm up a pool process so that the first request doesn't pay for set up
+
+    Args:
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+
+    Returns:
+        nothing
+    """
+    # a green square on a light background, so every stage runs once
+    image = np.full((32, 32, 3), 220, dtype=np.uint8)
+    image[8:24, 8:24] = (40, 140, 60)
+    Segmenter(use_lut=use_lut).segment(image)
+
+
+def segment_batch(requests, use_lut):
+    """
+    Segment a batch of requests in a pool process
+
+    Args:
+        requests (list): (data, fill, smooth, marker_intensity, image_format) of each request
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+
+    Returns:
+        list of (error or None, encoded output bytes or None) of each request,
+        error is an error code of ERROR_RESPONSES for images that can't be segmented
+        or the type and message of an unexpected exception, see batch.error_code,
+        which fails only its request
+    """
+    results = []
+    for data, fill, smooth, marker_intensity, image_format in requests:
+        settings = (fill, smooth, marker_intensity)
+        if settings not in worker_segmenters:
+            worker_segmenters[settings] = Segmenter(FILL[fill.upper()], smooth,
+                                                    marker_intensity, use_lut)
+        try:
+            output_image = worker_segmenters[settings].segment(decode_image(data))
+        except Exception as err:
+            results.append((error_code(err), None))
+            continue
+
+        _, encoded = cv2.imencode('.' + image_format, output_image)
+        results.append((None, encoded.tobytes()))
+
+    return results
+
+
+class PendingRequest:
+    """
+    A segmentation request waiting for its batch to complete
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.error = None
+        self.output = None
+        # set once the client stopped waiting, the request is not segmented then
+        self.cancelled = False
+
+
+class SegmentationServer:
+    """
+    HTTP segmentation service dispatching micro-batches to a warm process pool
+
+    POST /segment with image file bytes as body returns the segmented image,
+    or the mask if marker_intensity query parameter is set, and GET /health
+    returns queue depth and latency statistics as JSON
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, jobs=1, batch_size=8,
+                 max_wait=0.005, max_queue=64, use_lut=False, timeout=60):
+        """
+        Args:
+            host (string): address to listen on
+            port (int): port to listen on, 0 to pick a free one
+            jobs (int): number of segmenting processes
+            batch_size (int): maximum number of requests sent to a process at once
+            max_wait (float): seconds to wait for more requests to fill a batch
+            max_queue (int): number of queued and running requests beyond which
+                             requests are refused, timed out ones count until
+                             they are segmented or dropped from the queue
+            use_lut (boolean): mark colors with a compiled lookup table of the rules
+            timeout (float): seconds a request waits for its result
+        """
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.use_lut = use_lut
+        self.timeout = timeout
+
+        self.max_queue = max_queue
+        self.queue = Queue()
+        # requests queued or being segmented, until they leave the queue
+        # unsegmented or their batch completes
+        self.pending = 0
+        # at most two batches per process are in flight
+        self.slots = threading.Semaphore(2 * jobs)
+        self.latencies = deque(maxlen=1000)
+        self.counts = {'requests': 0, 'batches': 0, 'refused': 0, 'errors': 0, 'timeouts': 0}
+        self.lock = threading.Lock()
+
+        self.executor = ProcessPoolExecutor(jobs, initializer=init_worker,
+                                            initargs=(use_lut,))
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.threads = []
+
+    @property
+    def address(self):
+        """
+        Host and port the server listens on
+        """
+        return self.httpd.server_address[:2]
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == '/health':
+                    self.reply(200, 'application/json', json.dumps(server.health()).encode())
+                else:
+                    self.reply(404, 'text/plain', b'Not found')
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != '/segment':
+                    self.reply(404, 'text/plain', b'Not found')
+                    return
+
+                try:
+                    params = server.parse_params(parse_qs(url.query))
+                except ValueError as err:
+                    self.reply(400, 'text/plain', str(err).encode())
+                    return
+
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, content_type, body = server.segment(data, params)
+                self.reply(status, content_type, body)
+
+            def reply(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def parse_params(self, query):
+        """
+        Parse query parameters of a segmentation request
+
+        Args:
+            query (dict): parsed query string
+
+        Returns:
+            tuple of fill, smooth, marker_intensity and image format
+
+        Raises:
+            ValueError with a message if a parameter is invalid
+        """
+        def value(name, default):
+            return query.get(name, [default])[-1]
+
+        fill = value('fill', 'flood').lower()
+        if fill.upper() not in FILL:
+            raise ValueError('fill should be one of: ' + ', '.join(f.lower() for f in FILL))
+
+        smooth = value('smooth', '0').lower() in ('1', 'true', 'yes')
+
+        marker_intensity = int(value('marker_intensity', '0'))
+        if marker_intensity < 0 or marker_intensity > 255:
+            raise ValueError('marker_intensity should be between 0 and 255')
+
+        image_format = value('format', 'png').lower()
+        if image_format not in CONTENT_TYPES:
+            raise ValueError('format should be one of: ' + ', '.join(CONTENT_TYPES))
+
+        return fill, smooth, marker_intensity, image_format
+
+    def segment(self, data, params):
+        """
+        Queue image bytes for segmentation and wait for the result
+
+        Args:
+            data (bytes): content of an image file
+            params (tuple): see parse_params
+
+        Returns:
+            tuple of http status, content type and body
+        """
+        with self.lock:
+            if self.pending >= self.max_queue:
+                self.counts['refused'] += 1
+                return 503, 'text/plain', b'Too many requests queued'
+            self.pending += 1
+
+        request = PendingRequest(params)
+        request.data = data
+        self.queue.put(request)
+
+        if not request.done.wait(self.timeout):
+            # still pending, dispatch drops it if it is not being segmented yet
+            with self.lock:
+                request.cancelled = True
+                self.counts['timeouts'] += 1
+            return 504, 'text/plain', b'Segmentation timed out'
+
+        with self.lock:
+            self.counts['requests'] += 1
+            self.latencies.append(time.perf_counter() - request.received)
+
+        if request.error is not None:
+            with self.lock:
+                self.counts['errors'] += 1
+            status, message = ERROR_RESPONSES.get(request.error, (500, request.error.encode()))
+            return status, 'text/plain', message
+
+        return 200, CONTENT_TYPES[params[3]], request.output
+
+    def active(self, request):
+        """
+        Check if a queued request is still waited for, dropping it otherwise
+
+        Returns:
+            True if the request is to be segmented
+        """
+        with self.lock:
+            if request.cancelled:
+                self.pending -= 1
+                return False
+
+        return True
+
+    def dispatch(self):
+        """
+        Group queued requests into batches and hand them to the process pool
+        """
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            if not self.active(first):
+                continue
+
+            batch = [first]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                if self.active(request):
+                    batch.append(request)
+
+            self.slots.acquire()
+            with self.lock:
+                self.counts['batches'] += 1
+            future = self.executor.submit(
+                segment_batch, [(request.data,) + request.params for request in batch],
+                self.use_lut)
+            future.add_done_callback(lambda future, batch=batch: self.complete(batch, future))
+
+    def complete(self, batch, future):
+        """
+        Hand results of a batch to its waiting requests
+        """
+        self.slots.release()
+        try:
+            results = future.result()
+        except Exception as err:
+            results = [(str(err), None)] * len(batch)
+
+        with self.lock:
+            self.pending -= len(batch)
+
+        for request, (error, output) in zip(batch, results):
+            request.error = error
+            request.output = output
+            request.done.set()
+
+    def health(self):
+        """
+        Get health and latency statistics of the server
+
+        Returns:
+            dict of status, queue depth of queued and running requests,
+            counts and latency percentiles in seconds
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            counts = dict(self.counts)
+            pending = self.pending
+
+        latency = {'count': len(latencies)}
+        if len(latencies):
+            latency.update({
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            })
+
+        return dict(status='ok', queue_depth=pending, jobs=self.jobs,
+                    latency=latency, **counts)
+
+    def start(self):
+        """
+        Start serving on background threads
+
+        Returns:
+            nothing
+        """
+        # start every process now so they are warm for the first requests
+        for future in [self.executor.submit(segment_batch, [], self.use_lut)
+                       for _ in range(self.jobs)]:
+            future.result()
+
+        self.threads = [threading.Thread(target=self.dispatch, daemon=True),
+                        threading.Thread(target=self.httpd.serve_forever, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop serving and shut the process pool down
+
+        Returns:
+            nothing
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.queue.put(None)
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('server')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to listen on')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of segmenting processes')
+    parser.add_argument('-b', '--batch_size', type=int, default=8,
+                        help='Maximum number of requests sent to a process at once')
+    parser.add_argument('-w', '--max_wait', type=float, default=5,
+                        help='Milliseconds to wait for more requests to fill a batch')
+    parser.add_argument('-q', '--max_queue', type=int, default=64,
+                        help='Number of waiting requests beyond which requests are refused')
+    parser.add_argument('-l', '--lut', action='store_true',
+                        help='Mark colors with a lookup table of the color rules')
+    args = parser.parse_args()
+
+    server = SegmentationServer(args.host, args.port, args.jobs, args.batch_size,
+                                args.max_wait / 1000, args.max_queue, args.lut)
+    server.start()
+    print('Serving on http://{}:{}'.format(*server.address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
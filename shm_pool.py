@@ -0,0 +1,269 @@
+from collections import deque
+from queue import Queue
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from background_marker import FILL
+from segment import Segmenter
+
+
+# segmenter of a pool process, set up once by init_worker
+worker_segmenter = None
+
+# shared memory blocks a pool process attached to, by slot
+worker_blocks = {}
+
+
+def attach(name):
+    """
+    Attach to a shared memory block created by the pool's process
+
+    The creating process alone unlinks the block, so it is not tracked here
+
+    Args:
+        name (string): name of the block
+
+    Returns:
+        SharedMemory
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before python 3.13 attaching always registers the block, with the
+        # resource tracker pool processes share with their parent, which
+        # unregisters it on unlink
+        return shared_memory.SharedMemory(name)
+
+
+def init_worker(segmenter_args):
+    """
+    Set up the segmenter of a pool process
+
+    Args:
+        segmenter_args (tuple): arguments of Segmenter
+
+    Returns:
+        nothing
+    """
+    global worker_segmenter
+    worker_segmenter = Segmenter(*segmenter_args)
+
+
+def segment_slot(slot, name, shape, keep_original):
+    """
+    Segment the image in a slot in a pool process, writing the output in the slot
+
+    Args:
+        slot (int): index of the slot
+        name (string): name of the slot's shared memory block, it changes
+                       when the slot grows for a larger image
+        shape (tuple): shape of the image at the start of the block
+        keep_original (boolean): write a segmented image after the image rather
+                                 than into it, a mask is always written after it
+
+    Returns:
+        tuple[0] (tuple): shape of the output
+        tuple[1] (int): offset of the output in the block, 0 if written into the image
+    """
+    block = worker_blocks.get(slot)
+    if block is None or block.name != name:
+        if block is not None:
+            block.close()
+        block = worker_blocks[slot] = attach(name)
+
+    image = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+    largest_mask = worker_segmenter.mask(image)
+
+    if worker_segmenter.marker_intensity > 0:
+        out = np.ndarray(shape[:2], dtype=np.uint8, buffer=block.buf, offset=image.nbytes)
+    elif keep_original:
+        out = np.ndarray(shape, dtype=np.uint8, buffer=block.buf, offset=image.nbytes)
+    else:
+        out = image
+    worker_segmenter.output(image, largest_mask, out)
+
+    return out.shape, 0 if out is image else image.nbytes
+
+
+class SharedMemoryPool:
+    """
+    Process pool segmenting images passed through shared memory slots
+
+    A ring of slots, each a shared memory block, holds the images being
+    segmented and their outputs, so only slot indices and shapes cross
+    process boundaries rather than pickled arrays. An image is copied into
+    a free slot once, segmented there by a pool process and its output read
+    from the slot, which is then free for the next image. Submitting blocks
+    while every slot is in use, so memory stays bounded by the slots
+    """
+
+    def __init__(self, filling_mode=FILL['FLOOD'], smooth_boundary=False,
+                 marker_intensity=0, use_lut=False, coarse_scale=1,
+                 engine='color_index', jobs=2, slots=None):
+        """
+        Args:
+            filling_mode, smooth_boundary, marker_intensity, use_lut,
+            coarse_scale, engine: see Segmenter
+            jobs (int): number of segmenting processes
+            slots (int or None): number of images in flight, twice jobs if None
+        """
+        self.marker_intensity = marker_intensity
+        self.slots = 2 * jobs if slots is None else slots
+
+        # blocks are created on first use and grown for larger images
+        self.blocks = [None] * self.slots
+        self.free = Queue()
+        for slot in range(self.slots):
+            self.free.put(slot)
+
+        segmenter_args = (filling_mode, smooth_boundary, marker_intensity,
+                          use_lut, coarse_scale, None, engine)
+        self.executor = ProcessPoolExecutor(jobs, initializer=init_worker,
+                                            initargs=(segmenter_args,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def slot_block(self, slot, size):
+        """
+        Get the shared memory block of a slot, at least of a size
+
+        Args:
+            slot (int): index of the slot
+            size (int): bytes needed
+
+        Returns:
+            SharedMemory
+        """
+        block = self.blocks[slot]
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = self.blocks[slot] = shared_memory.SharedMemory(create=True, size=size)
+
+        return block
+
+    def submit(self, image, keep_original=False):
+        """
+        Copy an image into a free slot and have it segmented
+
+        Args:
+            image (ndarray): bgr image of uint8
+            keep_original (boolean): keep the image in the slot, rather than
+                                     segmenting it in place if output is the segmented image
+
+        Returns:
+            tuple of the slot and the future of segment_slot, see result
+        """
+        if self.marker_intensity > 0:
+            output_bytes = image.shape[0] * image.shape[1]
+        else:
+            output_bytes = image.nbytes if keep_original else 0
+
+        slot = self.free.get()
+        try:
+            block = self.slot_block(slot, image.nbytes + output_bytes)
+            np.ndarray(image.shape, dtype=np.uint8, buffer=block.buf)[...] = image
+            future = self.executor.submit(segment_slot, slot, block.name, image.shape,
+                                          keep_original)
+            future.shape = image.shape
+        except BaseException:
+            self.free.put(slot)
+            raise
+
+        return slot, future
+
+    def result(self, slot, future):
+        """
+        Wait for the output of a submitted image
+
+        The returned arrays are views of the slot, valid until the slot is released
+
+        Args:
+            slot, future: as returned by submit
+
+        Returns:
+            tuple[0] (ndarray): image of the slot, segmented in place
+                                unless kept or output is a mask
+            tuple[1] (ndarray): A mask to indicate where leaf is in the image
+                                or the segmented image based on marker_intensity value
+
+        Raises:
+            exceptions segmenting raised, the slot is released then
+        """
+        try:
+            output_shape, offset = future.result()
+        except BaseException:
+            self.release(slot)
+            raise
+
+        block = self.blocks[slot]
+        image = np.ndarray(future.shape, dtype=np.uint8, buffer=block.buf)
+        output = np.ndarray(output_shape, dtype=np.uint8, buffer=block.buf, offset=offset)
+
+        return image, output
+
+    def release(self, slot):
+        """
+        Free a slot for the next image, views of it must not be used anymore
+
+        Returns:
+            nothing
+        """
+        self.free.put(slot)
+
+    def segment(self, images):
+        """
+        Segment images, keeping every slot busy
+
+        Args:
+            images (iterable of ndarrays): bgr images
+
+        Returns:
+            generator of outputs in order of images, copied out of the slots
+        """
+        pending = deque()
+        images = iter(images)
+        try:
+            while True:
+                # submit ahead while slots are free, the oldest one is waited on otherwise
+                while len(pending) < self.slots:
+                    image = next(images, None)
+                    if image is None:
+                        break
+                    pending.append(self.submit(image))
+                if not pending:
+                    return
+
+                slot, future = pending.popleft()
+                _, output = self.result(slot, future)
+                try:
+                    yield output.copy()
+                finally:
+                    del output
+                    self.release(slot)
+        finally:
+            # slots are free again only once no process writes them anymore
+            for slot, future in pending:
+                if not future.cancel():
+                    future.exception()
+                self.release(slot)
+
+    def close(self):
+        """
+        Shut the pool down and free the shared memory
+
+        Returns:
+            nothing
+        """
+        self.executor.shutdown()
+        for block in self.blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.blocks = [None] * self.slots
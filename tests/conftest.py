@@ -0,0 +1,8 @@
+import os
+import sys
+
+
+# modules of the repository are imported by their names, as its scripts do
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY not in sys.path:
+    sys.path.insert(0, REPOSITORY)
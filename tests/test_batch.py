@@ -0,0 +1,94 @@
+import os
+import shutil
+
+import numpy as np
+import cv2
+import pytest
+
+from background_marker import FILL
+from utils import NO_LEAF
+from manifest import MANIFEST_FILE
+from batch import ERROR_MESSAGES, error_message, scan_files, run_serial, run_parallel, run_pipeline
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+
+
+def run_settings(base_folder, destination):
+    return {
+        'base_folder': base_folder,
+        'destination': destination,
+        'filling_mode': FILL['FLOOD'],
+        'smooth_boundary': False,
+        'marker_intensity': 0,
+        'with_original': False,
+        'use_lut': False,
+        'coarse_scale': 1,
+        'compare_full': False,
+        'metrics': False,
+        'trace_memory': False,
+        'cache_dir': None,
+        'cache_size': 0,
+        'decode_scale': 1,
+        'upscale': False,
+        'mask_format': 'image',
+        'engine': 'color_index',
+    }
+
+
+@pytest.mark.parametrize('run', [
+    run_serial,
+    run_pipeline,
+    lambda files, settings: run_parallel(files, settings, jobs=2, chunksize=1),
+])
+def test_unexpected_errors_fail_only_their_file(tmp_path, run):
+    source = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    source.mkdir()
+    destination.mkdir()
+
+    # a leaf, an image without any leaf, a file that is not an image
+    # and a leaf whose output folder is taken by a file
+    shutil.copy(os.path.join(TESTING_FILES, 'apple_healthy.JPG'), source / 'leaf.jpg')
+    (source / 'taken').mkdir()
+    shutil.copy(os.path.join(TESTING_FILES, 'apple_healthy.JPG'), source / 'taken' / 'leaf.jpg')
+    (destination / 'taken').write_text('not a folder')
+    cv2.imwrite(str(source / 'blank.png'), np.full((64, 64, 3), 255, dtype=np.uint8))
+    (source / 'broken.jpg').write_text('not an image')
+
+    files = ['blank.png', 'broken.jpg', 'leaf.jpg', os.path.join('taken', 'leaf.jpg')]
+    results = list(run(files, run_settings(str(source), str(destination))))
+
+    errors = {file: error for file, error, _ in results}
+    assert [file for file, _, _ in results] == files
+    assert errors['leaf.jpg'] is None
+    assert errors['broken.jpg'] in ERROR_MESSAGES
+    assert errors['blank.png'] == NO_LEAF
+    unexpected = errors[os.path.join('taken', 'leaf.jpg')]
+    assert unexpected.startswith('FileExistsError')
+    assert unexpected in error_message(unexpected)
+    assert sorted(os.listdir(destination)) == ['leaf_marked.jpg', 'taken']
+
+
+@pytest.mark.parametrize('recursive', [False, True])
+def test_scan_files_into_the_same_folder(tmp_path, recursive):
+    (tmp_path / 'sub').mkdir()
+    names = ['b.jpg', 'a.jpg', 'c.png', os.path.join('sub', 'd.jpg')]
+    # outputs of an earlier run and the manifest, which are not segmented again
+    names += ['a_marked.jpg', 'a_marked_merged.jpg', 'b_marked.1234.tmp.jpg', 'c_marked.json',
+              MANIFEST_FILE, MANIFEST_FILE + '-journal']
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+
+    files = []
+    for file in scan_files(str(tmp_path), recursive, exclude=str(tmp_path)):
+        files.append(file)
+        # outputs written while listing must not be listed in turn
+        for index in range(50):
+            root, ext = os.path.splitext(file)
+            (tmp_path / '{}_{}_marked{}'.format(root, index, ext)).write_bytes(b'')
+
+    expected = ['a.jpg', 'b.jpg', 'c.png']
+    if recursive:
+        expected.append(os.path.join('sub', 'd.jpg'))
+    assert files == expected
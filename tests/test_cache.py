@@ -0,0 +1,63 @@
+import numpy as np
+
+from cache import ResultCache, LOW_WATER_RATIO
+
+
+def cached_size(cache):
+    return sum(size for _, size, _ in cache.entries())
+
+
+def test_put_counts_replaced_masks_once(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    rng = np.random.default_rng(0)
+    masks = [(rng.random((64, 64)) < 0.5).astype(np.uint8) * 255 for _ in range(3)]
+
+    cache.put('a' * 64, masks[0])
+    cache.put('b' * 64, masks[1])
+    for mask in masks:
+        cache.put('a' * 64, mask)
+
+    assert cache.size == cached_size(cache)
+
+
+
+def test_eviction_sweeps_down_to_low_water(tmp_path):
+    rng = np.random.default_rng(1)
+    masks = [(rng.random((64, 64)) < 0.5).astype(np.uint8) * 255 for _ in range(20)]
+
+    probe = ResultCache(str(tmp_path / 'probe'))
+    probe.put('0' * 64, masks[0])
+    mask_size = probe.size
+
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=10 * mask_size)
+    keys = ['{:02d}'.format(index) * 32 for index in range(len(masks))]
+    for key, mask in zip(keys[:10], masks):
+        cache.put(key, mask)
+    # the oldest mask is used again, so it is the last to go
+    assert cache.get(keys[0]) is not None
+
+    cache.put(keys[10], masks[10])
+    assert cache.size <= LOW_WATER_RATIO * cache.max_bytes
+    assert cache.size == cached_size(cache)
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[10]) is not None
+
+    # masks put next fit in the room the sweep made without another one
+    evicted = len(cache.index)
+    cache.put(keys[11], masks[11])
+    assert len(cache.index) == evicted + 1
+
+
+def test_put_does_not_rescan(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), max_bytes=4096)
+    mask = np.zeros((64, 64), dtype=np.uint8)
+    cache.put('a' * 64, mask)
+
+    def entries():
+        raise AssertionError('cache directory scanned again')
+    monkeypatch.setattr(cache, 'entries', entries)
+
+    for index in range(50):
+        cache.put('{:02d}'.format(index) * 32, mask)
+    assert cache.size <= cache.max_bytes
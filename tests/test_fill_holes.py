@@ -0,0 +1,134 @@
+import os
+import glob
+
+import numpy as np
+import cv2
+import pytest
+
+from background_marker import FILL, select_largest_obj, fill_holes
+from segment import image_marker
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+IMAGE_FILES = sorted(glob.glob(os.path.join(TESTING_FILES, '*.JPG')))
+
+
+def generate_floodfill_mask(bin_image):
+    """
+    Mask of the background adjacent to the image edge of the flood chain, kept as the reference
+    """
+    y_mask = np.full(
+        (bin_image.shape[0], bin_image.shape[1]), fill_value=255, dtype=np.uint8
+    )
+    x_mask = np.full(
+        (bin_image.shape[0], bin_image.shape[1]), fill_value=255, dtype=np.uint8
+    )
+
+    xs, ys = bin_image.shape[0], bin_image.shape[1]
+
+    for x in range(0, xs):
+        item_indexes = np.where(bin_image[x, :] != 0)[0]
+        if len(item_indexes):
+            start_edge, final_edge = item_indexes[0], item_indexes[-1]
+            x_mask[x, start_edge:final_edge] = 0
+
+    for y in range(0, ys):
+        item_indexes = np.where(bin_image[:, y] != 0)[0]
+        if len(item_indexes):
+            start_edge, final_edge = item_indexes[0], item_indexes[-1]
+            y_mask[start_edge:final_edge, y] = 0
+
+    return np.logical_or(x_mask, y_mask)
+
+
+def flood_chain(img_bin, lab_val=255):
+    """
+    FLOOD filling of select_largest_obj before fill_holes, kept as the reference
+    """
+    n_labels, img_labeled, lab_stats, _ = \
+        cv2.connectedComponentsWithStats(img_bin, connectivity=8, ltype=cv2.CV_32S)
+    largest_obj_lab = np.argmax(lab_stats[1:, 4]) + 1
+
+    largest_mask = np.zeros(img_bin.shape, dtype=np.uint8)
+    largest_mask[img_labeled == largest_obj_lab] = lab_val
+
+    bkg_locs = np.where(img_labeled == 0)
+    bkg_seed = (bkg_locs[0][0], bkg_locs[1][0])
+
+    img_floodfill = largest_mask.copy()
+    h_, w_ = largest_mask.shape
+    mask_ = np.zeros((h_ + 2, w_ + 2), dtype=np.uint8)
+    cv2.floodFill(img_floodfill, mask_, seedPoint=bkg_seed, newVal=lab_val)
+    holes_mask = cv2.bitwise_not(img_floodfill)
+
+    non_holes_mask = generate_floodfill_mask(largest_mask)
+    holes_mask = np.bitwise_and(holes_mask, np.bitwise_not(non_holes_mask))
+
+    return largest_mask + holes_mask
+
+
+def edge_gaps(mask):
+    """
+    Background of a mask 4-connected to the image edge, left open by fill_holes
+    """
+    n_labels, labels = cv2.connectedComponents((mask == 0).view(np.uint8), connectivity=4)
+    edge_labels = np.unique(np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1])))
+
+    return (mask == 0) & np.isin(labels, edge_labels[edge_labels != 0])
+
+
+def binary_image(image_file):
+    bin_image = image_marker(cv2.imread(image_file)).view(np.uint8)
+    bin_image *= np.uint8(255)
+
+    return bin_image
+
+
+@pytest.mark.parametrize('image_file', IMAGE_FILES, ids=os.path.basename)
+def test_flood_matches_chain_but_for_edge_gaps(image_file):
+    bin_image = binary_image(image_file)
+
+    expected = flood_chain(bin_image.copy()) != 0
+    result = select_largest_obj(bin_image.copy(), fill_mode=FILL['FLOOD'])
+
+    # nothing is filled that the chain left open, and the chain filled more
+    # only in gaps between the leaf and the image edge, which are not holes
+    assert np.isin(result, (0, 255)).all()
+    assert not (result.astype(bool) & ~expected).any()
+    assert not (expected & ~result.astype(bool) & ~edge_gaps(result)).any()
+
+
+def test_flood_differs_only_on_the_documented_file():
+    differing = [os.path.basename(image_file) for image_file in IMAGE_FILES
+                 if not np.array_equal(
+                     select_largest_obj(binary_image(image_file), fill_mode=FILL['FLOOD']) != 0,
+                     flood_chain(binary_image(image_file)) != 0)]
+
+    assert differing == ['apple_black_rot_marked.JPG']
+
+
+def test_fill_holes_leaves_edge_gaps_open():
+    mask = np.zeros((9, 12), dtype=np.uint8)
+    mask[1:8, 1:11] = 255
+    # a hole, and a gap reaching the right edge
+    mask[3:5, 3:5] = 0
+    mask[5, 8:] = 0
+
+    filled = fill_holes(mask.copy())
+
+    assert (filled[3:5, 3:5] == 255).all()
+    assert (filled[5, 8:] == 0).all()
+    assert (filled[0] == 0).all()
+
+
+def test_fill_holes_with_many_labels():
+    # more holes than labels fitting a byte, one of them opened to the edge
+    mask = np.full((64, 64), 255, dtype=np.uint8)
+    mask[1:-1:2, 1:-1:2] = 0
+    mask[0, 1] = 0
+
+    expected = mask.copy()
+    expected[1:-1:2, 1:-1:2] = 7
+    expected[1, 1] = 0
+
+    np.testing.assert_array_equal(fill_holes(mask, 7), expected)
@@ -0,0 +1,84 @@
+import struct
+
+import numpy as np
+import cv2
+import pytest
+
+from utils import IMAGE_NOT_READ, decode_image, image_size, original_size
+
+# height and width of the test images, not multiples of the decode scales
+HEIGHT, WIDTH = 61, 90
+
+
+def leaf_image():
+    rng = np.random.default_rng(0)
+    image = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    image[:, :WIDTH // 2] = (40, 140, 60)
+    return image + rng.integers(0, 20, image.shape, dtype=np.uint8)
+
+
+def encode(extension, params=()):
+    return cv2.imencode(extension, leaf_image(), list(params))[1].tobytes()
+
+
+def exif_orientation(jpeg, orientation):
+    """
+    Insert an exif segment with an orientation tag after the start of image marker
+    """
+    tiff = b'MM\x00\x2a' + struct.pack('>I', 8) \
+        + struct.pack('>H', 1) + struct.pack('>HHIHH', 0x0112, 3, 1, orientation, 0) \
+        + struct.pack('>I', 0)
+    payload = b'Exif\x00\x00' + tiff
+    segment = b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+    return jpeg[:2] + segment + jpeg[2:]
+
+
+IMAGES = {
+    'baseline_jpeg': lambda: encode('.jpg'),
+    'progressive_jpeg': lambda: encode('.jpg', (cv2.IMWRITE_JPEG_PROGRESSIVE, 1)),
+    'png': lambda: encode('.png'),
+    'exif_rotated_jpeg': lambda: exif_orientation(encode('.jpg'), 6),
+}
+
+
+@pytest.mark.parametrize('name', list(IMAGES))
+def test_image_size_reads_the_header(name):
+    assert image_size(IMAGES[name]()) == (HEIGHT, WIDTH)
+
+
+def test_progressive_jpeg_has_its_own_start_of_frame():
+    assert b'\xff\xc2' in IMAGES['progressive_jpeg']()
+    assert b'\xff\xc0' not in IMAGES['progressive_jpeg']()
+
+
+@pytest.mark.parametrize('name', list(IMAGES))
+@pytest.mark.parametrize('decode_scale', [1, 2, 4, 8])
+def test_original_size_is_the_size_decoded_at_full_scale(name, decode_scale):
+    data = IMAGES[name]()
+    reduced = decode_image(data, decode_scale=decode_scale)
+
+    assert original_size(data, reduced.shape, decode_scale) == decode_image(data).shape[:2]
+
+
+def test_exif_rotation_swaps_sides():
+    data = IMAGES['exif_rotated_jpeg']()
+
+    assert decode_image(data).shape[:2] == (WIDTH, HEIGHT)
+    assert original_size(data, decode_image(data, decode_scale=2).shape, 2) == (WIDTH, HEIGHT)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'not an image',
+    encode('.jpg')[:20],
+    encode('.png')[:16],
+    b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 20,
+], ids=['empty', 'text', 'truncated_jpeg', 'truncated_png', 'jpeg_without_frame'])
+def test_image_size_of_truncated_or_other_files_is_none(data):
+    assert image_size(data) is None
+
+
+def test_original_size_of_other_files_fails_to_decode():
+    with pytest.raises(ValueError, match=IMAGE_NOT_READ):
+        original_size(b'not an image', (10, 10), 2)
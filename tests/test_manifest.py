@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from manifest import MANIFEST_FILE, Manifest, params_string
+
+PARAMS = params_string({'filling_mode': 1, 'smooth_boundary': False, 'version': 1})
+
+
+@pytest.fixture
+def folders(tmp_path):
+    source = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    source.mkdir()
+    destination.mkdir()
+    for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+        (source / name).write_bytes(name.encode())
+
+    return str(source), str(destination)
+
+
+def run(folders, params=PARAMS, errors=()):
+    """
+    Resume a run over the files of source, failing files in errors
+
+    Returns:
+        files the run segmented or tried, and the number it skipped
+    """
+    source, destination = folders
+    manifest = Manifest(destination)
+    files = list(manifest.pending(sorted(os.listdir(source)), source, params))
+    for file in files:
+        output = os.path.join(destination, file)
+        if file in errors:
+            manifest.record(file, source, params, output, 'IMAGE_NOT_READ')
+        else:
+            with open(output, 'wb') as output_file:
+                output_file.write(b'mask')
+            manifest.record(file, source, params, output)
+    manifest.close()
+
+    return files, manifest.skipped
+
+
+def test_done_files_are_skipped(folders):
+    assert run(folders) == (['a.jpg', 'b.jpg', 'c.jpg'], 0)
+    assert run(folders) == ([], 3)
+    assert os.path.exists(os.path.join(folders[1], MANIFEST_FILE))
+
+
+def test_failed_files_are_retried(folders):
+    assert run(folders, errors=('b.jpg',)) == (['a.jpg', 'b.jpg', 'c.jpg'], 0)
+    assert run(folders, errors=('b.jpg',)) == (['b.jpg'], 2)
+    assert run(folders) == (['b.jpg'], 2)
+    assert run(folders) == ([], 3)
+
+
+def test_changed_params_invalidate_records(folders):
+    run(folders)
+    changed = params_string({'filling_mode': 2, 'smooth_boundary': False, 'version': 1})
+
+    assert run(folders, changed) == (['a.jpg', 'b.jpg', 'c.jpg'], 0)
+    assert run(folders, changed) == ([], 3)
+    assert run(folders) == (['a.jpg', 'b.jpg', 'c.jpg'], 0)
+
+
+def test_changed_inputs_and_missing_outputs_are_segmented_again(folders):
+    source, destination = folders
+    run(folders)
+
+    with open(os.path.join(source, 'a.jpg'), 'ab') as image_file:
+        image_file.write(b'edited')
+    os.remove(os.path.join(destination, 'c.jpg'))
+
+    assert run(folders) == (['a.jpg', 'c.jpg'], 1)
+
+
+def test_params_string_ignores_key_order():
+    assert params_string({'b': 1, 'a': [2, 3]}) == params_string({'a': [2, 3], 'b': 1})
+    assert params_string({'a': 1}) != params_string({'a': 2})
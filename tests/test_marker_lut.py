@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import background_marker
+from background_marker import compile_marker_lut, load_marker_lut, marker_lut_key, \
+    lut_marker, color_index_marker, remove_whites, remove_blacks, remove_blues
+from utils import index_diff
+
+
+def color_sample(count=200000, seed=0):
+    # random colors plus the grays and pure channels where rules tend to break
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, (count, 3), dtype=np.uint8)
+    values = np.arange(256, dtype=np.uint8)
+    edges = np.concatenate([
+        np.stack([values] * 3, axis=1),
+        np.stack([values, np.zeros_like(values), np.zeros_like(values)], axis=1),
+        np.stack([np.zeros_like(values), values, np.zeros_like(values)], axis=1),
+        np.stack([np.zeros_like(values), np.zeros_like(values), values], axis=1),
+    ])
+
+    return np.concatenate([colors, edges])[None]
+
+
+@pytest.mark.parametrize('rules', [
+    {},
+    {'index_threshold': 0.1},
+    {'index_threshold': -0.3, 'green_scale': 1.5, 'red_scale': 1.2},
+    {'whites': True, 'blacks': True, 'blues': True},
+    {'index_threshold': None, 'blues': True},
+])
+def test_lut_matches_color_rules(rules):
+    image = color_sample()
+    index_threshold = rules.get('index_threshold', -0.05)
+
+    expected = np.ones(image.shape[:2], dtype=bool)
+    if index_threshold is not None:
+        color_index_marker(index_diff(image, rules.get('green_scale', 2.0),
+                                      rules.get('red_scale', 1.4)),
+                           expected, index_threshold)
+    if rules.get('whites'):
+        remove_whites(image, expected)
+    if rules.get('blacks'):
+        remove_blacks(image, expected)
+    if rules.get('blues'):
+        remove_blues(image, expected)
+
+    marker = np.ones(image.shape[:2], dtype=bool)
+    lut_marker(image, marker, compile_marker_lut(**rules))
+
+    np.testing.assert_array_equal(marker, expected)
+
+
+def test_key_changes_with_rules(monkeypatch):
+    key = marker_lut_key()
+
+    assert marker_lut_key() == key
+    assert marker_lut_key(index_threshold=-0.05) != key
+    assert marker_lut_key(index_threshold=-0.04) != marker_lut_key(index_threshold=-0.05)
+    assert marker_lut_key(green_scale=2.1) != key
+    assert marker_lut_key(blues=True) != key
+
+    monkeypatch.setattr(background_marker, 'MARKER_LUT_VERSION',
+                        background_marker.MARKER_LUT_VERSION + 1)
+    assert marker_lut_key() != key
+
+
+def test_cached_lut_reads_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(background_marker, 'marker_luts', {})
+    lut = load_marker_lut(str(tmp_path), blues=True)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # read from disk rather than compiled again
+    monkeypatch.setattr(background_marker, 'marker_luts', {})
+    monkeypatch.setattr(background_marker, 'compile_marker_lut', None)
+    np.testing.assert_array_equal(load_marker_lut(str(tmp_path), blues=True), lut)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from mask_io import decode_rle, encode_rle, mask_filename, read_mask, write_mask
+
+
+def masks():
+    rng = np.random.default_rng(0)
+    starts_with_leaf = np.zeros((7, 5), dtype=np.uint8)
+    starts_with_leaf[:3, :2] = 255
+    starts_with_leaf[5:, 3:] = 1
+
+    return {
+        'starts_with_leaf': starts_with_leaf,
+        'empty': np.zeros((6, 9), dtype=np.uint8),
+        'full': np.full((9, 6), 255, dtype=np.uint8),
+        'random': (rng.random((13, 11)) < 0.5).astype(np.uint8) * 255,
+        'single_pixel': np.full((1, 1), 255, dtype=np.uint8),
+    }
+
+
+@pytest.mark.parametrize('mask_format', ['png', 'rle', 'coco', 'npz'])
+@pytest.mark.parametrize('name', list(masks()))
+def test_masks_read_back_as_written(tmp_path, mask_format, name):
+    mask = masks()[name]
+    file = mask_filename(str(tmp_path / 'leaf_marked.jpg'), mask_format)
+    write_mask(file, mask, mask_format)
+
+    np.testing.assert_array_equal(read_mask(file), np.where(mask > 0, 255, 0))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_rle_counts_start_with_background(compress):
+    mask = np.array([[1, 0], [1, 1], [0, 1]], dtype=np.uint8)
+    rle = encode_rle(mask, compress)
+
+    assert rle['size'] == [3, 2]
+    assert rle['counts'] == ('0220' if compress else [0, 2, 2, 2])
+    np.testing.assert_array_equal(decode_rle(rle), mask * 255)
+
+
+def test_compressed_counts_known_answer():
+    # runs of 5, 40, 3, 2 and 100 take a two character count, a negative
+    # difference to the count two runs before and a positive one
+    mask = np.repeat(np.array([0, 1, 0, 1, 0], dtype=np.uint8), [5, 40, 3, 2, 100])[None]
+    rle = encode_rle(mask, compress=True)
+
+    assert rle == {'size': [1, 150], 'counts': '5X13jNQ3'}
+    np.testing.assert_array_equal(decode_rle(rle), mask * 255)
@@ -0,0 +1,58 @@
+import os
+import glob
+
+import numpy as np
+import cv2
+import pytest
+
+from otsu_segmentation import get_marker, apply_marker, leaf_is_bright, \
+    BRIGHT_BACKGROUND_RATIO
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+IMAGE_FILES = sorted(glob.glob(os.path.join(TESTING_FILES, '*.JPG')))
+
+
+def apply_marker_absolute(image, marker, background=0, inverse=True):
+    """
+    apply_marker deciding with an absolute margin of pixels, kept as the reference
+    """
+    mask = marker.astype(bool)
+    unique, counts = np.unique(mask, return_counts=True)
+    unique_counts = dict(zip(unique, counts))
+    if inverse and unique_counts[True] - unique_counts[False] < 2000000:
+        mask = np.logical_not(mask)
+
+    new_image = image.copy()
+    new_image[mask] = background
+    new_image[~mask] = 255
+
+    return new_image
+
+
+@pytest.mark.parametrize('image_file', IMAGE_FILES, ids=os.path.basename)
+def test_testing_files_keep_bright_leaf(image_file):
+    image = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    _, marker = get_marker(image)
+
+    assert leaf_is_bright(np.count_nonzero(marker), marker.size)
+    for background in (0, 100):
+        np.testing.assert_array_equal(apply_marker(image, marker, background),
+                                      apply_marker_absolute(image, marker, background))
+
+
+def test_mostly_bright_images_have_dark_leaf():
+    # the decision flips at a bright share of (1 + ratio) / 2, at any resolution
+    flip = (1 + BRIGHT_BACKGROUND_RATIO) / 2
+    for pixel_count in (256 * 256, 12000000):
+        below = int(pixel_count * (flip - 0.01))
+        above = int(pixel_count * (flip + 0.01))
+        assert leaf_is_bright(below, pixel_count)
+        assert not leaf_is_bright(above, pixel_count)
+
+    # where the absolute margin kept small images bright
+    image = np.full((256, 256), 40, dtype=np.uint8)
+    image[:, :int(256 * (flip + 0.05))] = 220
+    _, marker = get_marker(image)
+    assert apply_marker(image, marker)[0, 0] == 0
+    assert apply_marker_absolute(image, marker)[0, 0] == 255
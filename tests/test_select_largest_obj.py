@@ -0,0 +1,107 @@
+import os
+import glob
+
+import numpy as np
+import cv2
+import pytest
+
+from background_marker import FILL, select_largest_obj
+from segment import image_marker
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+IMAGE_FILES = sorted(glob.glob(os.path.join(TESTING_FILES, '*.JPG')))
+
+
+def full_image_select(img_bin, lab_val=255, fill_mode=FILL['FLOOD'],
+                      smooth_boundary=False, kernel_size=15):
+    """
+    select_largest_obj working on the whole image, kept as the reference
+    of the no, threshold and morph modes
+    """
+    n_labels, img_labeled, lab_stats, _ = \
+        cv2.connectedComponentsWithStats(img_bin, connectivity=8, ltype=cv2.CV_32S)
+    largest_obj_lab = np.argmax(lab_stats[1:, 4]) + 1
+
+    largest_mask = np.zeros(img_bin.shape, dtype=np.uint8)
+    largest_mask[img_labeled == largest_obj_lab] = lab_val
+
+    if fill_mode == FILL['MORPH']:
+        kernel_ = np.ones((50, 50), dtype=np.uint8)
+        largest_mask = cv2.morphologyEx(largest_mask, cv2.MORPH_CLOSE, kernel_)
+    elif fill_mode == FILL['THRESHOLD']:
+        inv_img_bin = np.bitwise_not(largest_mask)
+        inv_n_labels, inv_img_labeled, inv_lab_stats, _ = \
+            cv2.connectedComponentsWithStats(inv_img_bin, connectivity=8, ltype=cv2.CV_32S)
+
+        inv_sizes = inv_lab_stats[1:, -1]
+        sizes = lab_stats[1:, -1]
+        inv_nb_components = inv_n_labels - 1
+        inv_min_size = int(0.3 * sizes[largest_obj_lab - 1])
+
+        inv_mask = np.zeros((inv_img_labeled.shape), dtype=np.uint8)
+        for inv_i in range(0, inv_nb_components):
+            if inv_sizes[inv_i] >= inv_min_size:
+                inv_mask[inv_img_labeled == inv_i + 1] = 255
+
+        largest_mask = largest_mask + np.bitwise_not(inv_mask)
+
+    if smooth_boundary:
+        kernel_ = np.ones((kernel_size, kernel_size), dtype=np.uint8)
+        largest_mask = cv2.morphologyEx(largest_mask, cv2.MORPH_OPEN, kernel_)
+
+    return largest_mask
+
+
+def edge_touching_masks():
+    """
+    Masks of a leaf reaching one or more image edges, with holes of many
+    sizes, gaps open to the edge and smaller objects around it
+    """
+    masks = []
+    for seed in range(6):
+        rng = np.random.default_rng(seed)
+        height, width = rng.integers(90, 200, 2)
+        noise = cv2.GaussianBlur(rng.random((height, width)), (0, 0), rng.uniform(2, 6))
+        mask = ((noise > np.quantile(noise, rng.uniform(0.3, 0.6))) * 255).astype(np.uint8)
+
+        # a leaf cut by the edges this seed picks
+        top, left = rng.integers(-40, 40, 2)
+        cv2.ellipse(mask, (int(width // 2 + left), int(height // 2 + top)),
+                    (int(width * 0.45), int(height * 0.45)), 0, 0, 360, 255, -1)
+        for _ in range(6):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.circle(mask, center, int(rng.integers(1, 15)), 0, -1)
+        masks.append(mask)
+
+    # markers of the testing files, two of them reach the image edge
+    for image_file in IMAGE_FILES:
+        masks.append(image_marker(cv2.imread(image_file)).view(np.uint8) * np.uint8(255))
+
+    return masks
+
+
+MASKS = edge_touching_masks()
+
+
+def test_leaves_touch_image_edges():
+    touching = 0
+    for mask in MASKS:
+        x, y, w, h = cv2.boundingRect(select_largest_obj(mask.copy(), fill_mode=FILL['NO']))
+        touching += x == 0 or y == 0 or x + w == mask.shape[1] or y + h == mask.shape[0]
+
+    assert touching == len(MASKS) - 2
+
+
+@pytest.mark.parametrize('fill_mode', ['NO', 'THRESHOLD', 'MORPH'])
+@pytest.mark.parametrize('smooth_boundary', [False, True])
+@pytest.mark.parametrize('index', range(len(MASKS)))
+def test_roi_matches_full_image(fill_mode, smooth_boundary, index):
+    mask = MASKS[index]
+
+    expected = full_image_select(mask.copy(), fill_mode=FILL[fill_mode],
+                                 smooth_boundary=smooth_boundary)
+    result = select_largest_obj(mask.copy(), fill_mode=FILL[fill_mode],
+                                smooth_boundary=smooth_boundary)
+
+    np.testing.assert_array_equal(result != 0, expected != 0)
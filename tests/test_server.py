@@ -0,0 +1,68 @@
+import json
+import time
+from urllib.request import urlopen
+
+import numpy as np
+import cv2
+
+from server import SegmentationServer
+
+
+def leaf_png(leaf=True):
+    image = np.full((32, 32, 3), 220, dtype=np.uint8)
+    if leaf:
+        image[8:24, 8:24] = (40, 140, 60)
+
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline
+        time.sleep(0.01)
+
+
+def test_timed_out_requests_count_until_dropped():
+    server = SegmentationServer(port=0, jobs=1, max_queue=2, timeout=0.05)
+    params = ('flood', False, 0, 'png')
+    try:
+        # nothing dispatches yet, so both requests time out while queued
+        for _ in range(2):
+            assert server.segment(leaf_png(), params)[0] == 504
+        assert server.health()['queue_depth'] == 2
+        assert server.segment(leaf_png(), params)[0] == 503
+
+        server.start()
+        wait_for(lambda: server.health()['queue_depth'] == 0)
+        assert server.health()['batches'] == 0
+        assert server.health()['timeouts'] == 2
+
+        server.timeout = 60
+        assert server.segment(leaf_png(), params)[0] == 200
+        with urlopen('http://{}:{}/health'.format(*server.address)) as response:
+            health = json.load(response)
+        assert health['queue_depth'] == 0
+        assert health['requests'] == 1
+    finally:
+        if server.threads:
+            server.stop()
+        else:
+            # stop waits for serving to end, which never started
+            server.httpd.server_close()
+            server.executor.shutdown()
+
+
+def test_images_that_cannot_be_segmented_are_client_errors():
+    server = SegmentationServer(port=0, jobs=1, timeout=60)
+    params = ('flood', False, 0, 'png')
+    server.start()
+    try:
+        assert server.segment(leaf_png(leaf=False), params) == \
+            (422, 'text/plain', b'No leaf found in image')
+        assert server.segment(b'not an image', params) == \
+            (400, 'text/plain', b'Could not read image')
+        assert server.segment(leaf_png(), params)[0] == 200
+        assert server.health()['errors'] == 2
+    finally:
+        server.stop()
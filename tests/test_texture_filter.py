@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from background_marker import texture_filter
+
+
+def texture_filter_loop(image, marker, threshold=220, window=3):
+    """
+    Per pixel texture_filter it replaced, kept as the reference
+    """
+    window = window - window//2 - 1
+    for x in range(0, image.shape[0]):
+        for y in range(0, image.shape[1]):
+            x_start = x - window if x < window else x
+            y_start = y - window if y < window else y
+            x_stop = x + window if x < image.shape[0] - window else image.shape[0]
+            y_stop = y + window if y < image.shape[1] - window else image.shape[1]
+
+            local_entropy = np.sum(image[x_start:x_stop, y_start:y_stop]
+                                   * np.log(image[x_start:x_stop, y_start:y_stop] + 1e-07))
+            if local_entropy > threshold:
+                marker[x, y] = False
+
+
+@pytest.mark.parametrize('window', [1, 2, 3, 4, 5, 8, 9, 25, 40])
+@pytest.mark.parametrize('shape', [(1, 1), (3, 7), (12, 9), (17, 23), (45, 38)])
+def test_texture_filter_matches_loop(window, shape):
+    rng = np.random.default_rng(window * 100 + shape[0])
+    image = rng.integers(0, 256, shape, dtype=np.uint8)
+    marker = rng.random(shape) < 0.7
+
+    # thresholds spread over the range of local entropies of the windows
+    for threshold in (0, 220, 1000, 5000, 20000):
+        expected = marker.copy()
+        texture_filter_loop(image, expected, threshold, window)
+        result = marker.copy()
+        texture_filter(image, result, threshold, window)
+
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('window', [3, 4, 30])
+def test_texture_filter_matches_loop_on_float_images(window):
+    rng = np.random.default_rng(window)
+    image = rng.random((11, 14)) * 255
+    marker = np.ones(image.shape, dtype=bool)
+
+    expected = marker.copy()
+    texture_filter_loop(image, expected, 1500, window)
+    texture_filter(image, marker, 1500, window)
+
+    np.testing.assert_array_equal(marker, expected)
@@ -0,0 +1,88 @@
+import os
+import glob
+
+import numpy as np
+import cv2
+import pytest
+
+from background_marker import FILL
+from segment import leaf_mask
+from tiled import STRIP_BYTES_PER_PIXEL, StripComponents, strips, tiled_leaf_mask
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+IMAGE_FILES = sorted(glob.glob(os.path.join(TESTING_FILES, '*.JPG')))
+
+# rows of a strip when marking, so the leaf spans several strip seams
+STRIP_ROWS = 16
+
+
+def small_image(file):
+    image = cv2.imread(file)
+    return cv2.resize(image, (160, 160 * image.shape[0] // image.shape[1]),
+                      interpolation=cv2.INTER_AREA)
+
+
+@pytest.mark.parametrize('file', IMAGE_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('fill', list(FILL))
+@pytest.mark.parametrize('smooth', [False, True])
+def test_tiled_leaf_mask_matches_leaf_mask(tmp_path, file, fill, smooth):
+    image = small_image(file)
+    budget = STRIP_ROWS * image.shape[1] * STRIP_BYTES_PER_PIXEL
+    expected = leaf_mask(image, FILL[fill], smooth)
+    assert expected[:STRIP_ROWS].any() or expected[STRIP_ROWS:2 * STRIP_ROWS].any()
+
+    mask_file = str(tmp_path / 'mask.npy')
+    tiled_leaf_mask(image, mask_file, FILL[fill], smooth, budget=budget, work_dir=str(tmp_path))
+
+    np.testing.assert_array_equal(np.load(mask_file), expected)
+
+
+def strip_labels(mask, rows, connectivity):
+    components = StripComponents(connectivity)
+    for start, stop, _, _ in strips(mask.shape[0], rows):
+        components.add(mask[start:stop], start == 0, stop == mask.shape[0])
+    areas, border = components.resolve()
+
+    labels = np.zeros(mask.shape, dtype=np.int64)
+    for index, (start, stop, _, _) in enumerate(strips(mask.shape[0], rows)):
+        local, _ = components.label(mask[start:stop])
+        labels[start:stop] = components.lookup(index, components.parent + 1, 0)[local]
+
+    return labels, areas, border
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('rows', [1, 3, 7])
+def test_strip_components_match_whole_image(connectivity, rows):
+    rng = np.random.default_rng(rows)
+    for density in (0.3, 0.5, 0.6):
+        mask = (rng.random((40, 30)) < density).astype(np.uint8)
+        labels, areas, border = strip_labels(mask, rows, connectivity)
+        _, expected = cv2.connectedComponents(mask, connectivity=connectivity,
+                                              ltype=cv2.CV_32S)
+
+        # the same pixels make up every component
+        pairs = np.unique(np.stack((labels.ravel(), expected.ravel()), axis=1), axis=0)
+        assert len(np.unique(pairs[:, 0])) == len(pairs)
+        assert len(np.unique(pairs[:, 1])) == len(pairs)
+
+        sizes = np.bincount(labels.ravel())
+        roots = labels[mask > 0] - 1
+        np.testing.assert_array_equal(areas[roots], sizes[roots + 1])
+
+        edges = np.zeros_like(mask, dtype=bool)
+        edges[[0, -1]] = edges[:, [0, -1]] = True
+        touching = np.unique(labels[edges & (mask > 0)])
+        np.testing.assert_array_equal(border[roots], np.isin(roots + 1, touching))
+
+
+def test_zigzag_merges_across_many_seams():
+    # a comb whose teeth meet only at the bottom row, one strip row at a time
+    mask = np.zeros((20, 41), dtype=np.uint8)
+    mask[:, ::2] = 1
+    mask[-1] = 1
+    labels, areas, _ = strip_labels(mask, 1, 4)
+
+    assert len(np.unique(labels[mask > 0])) == 1
+    assert areas.max() == mask.sum()
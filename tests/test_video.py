@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import cv2
+import pytest
+
+from video import segment_video
+
+TESTING_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'testing_files')
+
+
+@pytest.mark.parametrize('marker_intensity', [0, 255])
+def test_frames_without_leaf_get_empty_output(tmp_path, marker_intensity):
+    leaf = cv2.imread(os.path.join(TESTING_FILES, 'apple_healthy.JPG'))
+    blank = np.full_like(leaf, 255)
+
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    for index, frame in enumerate([leaf, leaf, blank, leaf]):
+        cv2.imwrite(str(frames / '{:02d}.png'.format(index)), frame)
+
+    output = tmp_path / 'output'
+    count, counts, _ = segment_video(str(frames), str(output),
+                                     marker_intensity=marker_intensity)
+
+    # the frame after the blank one is segmented in a full pass again
+    assert count == 4
+    assert counts == {'full': 3, 'seeded': 1}
+
+    outputs = [cv2.imread(str(output / name)) for name in sorted(os.listdir(output))]
+    assert not outputs[2].any()
+    assert outputs[3].any()
+    np.testing.assert_array_equal(outputs[3], outputs[0])
@@ -0,0 +1,539 @@
+import os
+import argparse
+import tempfile
+import numpy as np
+import cv2
+
+from utils import *
+from background_marker import *
+from segment import image_marker, read_image_file, rgb_range
+
+
+# approximate bytes held per pixel of a strip while marking it: the bgr strip,
+# float64 color index arrays, the marker and the int32 labels of its components
+STRIP_BYTES_PER_PIXEL = 64
+
+
+def strip_rows(width, budget, halo=0):
+    """
+    Get the number of image rows processed at once to stay within a memory budget
+
+    Args:
+        width (int): image width
+        budget (int): bytes a strip may take while processed
+        halo (int): rows read above and below a strip for morphology
+
+    Returns:
+        number of rows of a strip, at least 1
+    """
+    return max(1, budget // (width * STRIP_BYTES_PER_PIXEL) - 2 * halo)
+
+
+def create_npy(file, shape, dtype=np.uint8):
+    """
+    Create a .npy file of an array without holding the array in memory
+
+    Args:
+        file (string): path of the file
+        shape (tuple): shape of the array, first axis is rows
+        dtype: type of the array
+
+    Returns:
+        nothing
+    """
+    array = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+    del array
+
+
+def npy_rows(file, start, stop, mode='r'):
+    """
+    Map rows of an array in a .npy file
+
+    Only the rows are mapped, so pages of other rows never count towards
+    the memory of the process
+
+    Args:
+        file (string): path of a .npy file in C order
+        start (int): first row
+        stop (int): row after the last one
+        mode (string): 'r' to read, 'r+' to write
+
+    Returns:
+        np.memmap of the rows
+    """
+    with open(file, 'rb') as npy:
+        version = np.lib.format.read_magic(npy)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy)
+        offset = npy.tell()
+
+    if fortran_order:
+        raise ValueError('{}: is not in C order'.format(file))
+
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+    return np.memmap(file, dtype=dtype, mode=mode, offset=offset + start * row_bytes,
+                     shape=(stop - start,) + tuple(shape[1:]))
+
+
+def strips(height, rows, halo=0):
+    """
+    Split image rows into strips
+
+    Args:
+        height (int): image height
+        rows (int): rows of a strip
+        halo (int): rows read above and below a strip
+
+    Returns:
+        generator of (start, stop, read_start, read_stop) of every strip,
+        rows read are clipped to the image
+    """
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        yield start, stop, max(0, start - halo), min(height, stop + halo)
+
+
+class StripComponents:
+    """
+    Connected components of a binary image labeled strip by strip
+
+    Each strip is labeled on its own, labels are numbered globally by adding
+    the number of labels of the strips before, and labels touching across a
+    strip seam are merged with union find. Label arrays grow geometrically
+    with count the number of labels in use, and are cut to count by resolve
+    """
+
+    def __init__(self, connectivity=8):
+        """
+        Args:
+            connectivity (int {4, 8}): connectivity of components
+        """
+        self.connectivity = connectivity
+        self.count = 0
+        self.parent = np.zeros(0, dtype=np.int64)
+        self.areas = np.zeros(0, dtype=np.int64)
+        self.border = np.zeros(0, dtype=bool)
+
+        # global number of the first label of each strip, global labels of the last row
+        self.offsets = []
+        self.last_row = None
+
+    def label(self, strip):
+        """
+        Label components of a strip of foreground
+
+        Args:
+            strip (ndarray): rows of a binary image, nonzero foreground
+
+        Returns:
+            ndarray of int32 labels, 0 for background and local labels from 1
+        """
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(
+            strip.view(np.uint8), connectivity=self.connectivity, ltype=cv2.CV_32S)
+
+        return labels, stats
+
+    def add(self, strip, first, last):
+        """
+        Label the next strip of the image and merge it with the strip above
+
+        Args:
+            strip (ndarray): rows of a binary image, nonzero foreground
+            first (boolean): strip holds the first image row
+            last (boolean): strip holds the last image row
+
+        Returns:
+            nothing
+        """
+        labels, stats = self.label(strip)
+        offset = self.count
+        self.offsets.append(offset)
+
+        # global labels of the strip, -1 for background
+        count = len(stats) - 1
+        self.reserve(offset + count)
+        self.count = offset + count
+        self.parent[offset:self.count] = np.arange(offset, self.count)
+        self.areas[offset:self.count] = stats[1:, cv2.CC_STAT_AREA]
+
+        border = np.zeros(count + 1, dtype=bool)
+        border[labels[:, 0]] = True
+        border[labels[:, -1]] = True
+        if first:
+            border[labels[0]] = True
+        if last:
+            border[labels[-1]] = True
+        self.border[offset:self.count] = border[1:]
+
+        first_row = np.where(labels[0] > 0, labels[0] + offset - 1, -1)
+        if self.last_row is not None:
+            self.merge(self.last_row, first_row)
+        self.last_row = np.where(labels[-1] > 0, labels[-1] + offset - 1, -1)
+
+    def merge(self, above, below):
+        """
+        Merge labels of two adjacent rows that touch each other
+
+        Args:
+            above (ndarray): global labels of the last row of a strip
+            below (ndarray): global labels of the first row of the next strip
+
+        Returns:
+            nothing
+        """
+        shifts = (0,) if self.connectivity == 4 else (-1, 0, 1)
+        pairs = []
+        for shift in shifts:
+            # pixel x of the row above touches pixel x + shift below
+            a = above[max(0, -shift):len(above) - max(0, shift)]
+            b = below[max(0, shift):len(below) - max(0, -shift)]
+            touching = (a >= 0) & (b >= 0)
+            pairs.append(np.stack((a[touching], b[touching]), axis=1))
+
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        if not len(pairs):
+            return
+
+        # roots of the labels above, labels below are roots of their own
+        roots = pairs[:, 0]
+        while True:
+            parents = self.parent[roots]
+            if np.array_equal(parents, roots):
+                break
+            roots = parents
+
+        # components of the graph of touching roots, each labeled by its
+        # smallest root, found by spreading minimums along edges
+        nodes, edges = np.unique(np.concatenate((roots, pairs[:, 1])), return_inverse=True)
+        edges = edges.reshape(2, -1)
+        component = np.arange(len(nodes))
+        while True:
+            smallest = np.minimum(component[edges[0]], component[edges[1]])
+            spread = component.copy()
+            np.minimum.at(spread, edges[0], smallest)
+            np.minimum.at(spread, edges[1], smallest)
+            spread = spread[spread]
+            if np.array_equal(spread, component):
+                break
+            component = spread
+
+        self.parent[nodes] = nodes[component]
+        self.parent[pairs[:, 0]] = self.parent[roots]
+
+    def reserve(self, count):
+        """
+        Grow label arrays to hold count labels, doubling their size so
+        adding a strip takes amortized constant time per label
+
+        Args:
+            count (int): number of labels to hold
+
+        Returns:
+            nothing
+        """
+        if count <= len(self.parent):
+            return
+
+        size = max(count, 2 * len(self.parent))
+        for name in ('parent', 'areas', 'border'):
+            array = getattr(self, name)
+            grown = np.zeros(size, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+    def resolve(self):
+        """
+        Point every label at the root of its component and sum component stats at roots
+
+        Returns:
+            tuple[0] (ndarray): area of the component of every label
+            tuple[1] (ndarray of booleans): component of every label touches the image border
+        """
+        self.parent = self.parent[:self.count]
+        self.areas = self.areas[:self.count]
+        self.border = self.border[:self.count]
+
+        while True:
+            grand_parent = self.parent[self.parent]
+            if np.array_equal(grand_parent, self.parent):
+                break
+            self.parent = grand_parent
+
+        areas = np.bincount(self.parent, weights=self.areas,
+                            minlength=len(self.parent)).astype(np.int64)
+        border = np.zeros(len(self.parent), dtype=bool)
+        np.logical_or.at(border, self.parent, self.border)
+
+        return areas[self.parent], border[self.parent]
+
+    def lookup(self, index, values, background):
+        """
+        Get a lookup table from local labels of a strip to values of their components
+
+        Args:
+            index (int): index of the strip in order of add
+            values (ndarray): value of every global label
+            background: value of local label 0
+
+        Returns:
+            ndarray indexed by local labels of the strip
+        """
+        offset = self.offsets[index]
+        stop = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.count
+
+        return np.concatenate(([background], values[offset:stop])).astype(values.dtype)
+
+
+def relabel(source, target, height, rows, components, values, background, invert=False):
+    """
+    Write values of components of every pixel strip by strip
+
+    Args:
+        source (string): .npy file of the binary image the components were labeled on
+        target (string): .npy file to write values to
+        height (int): image height
+        rows (int): rows of a strip, same as when labeled
+        components (StripComponents): components of source
+        values (ndarray of uint8): value of every global label
+        background (uint8): value of background pixels
+        invert (boolean): components were labeled on zeros of source
+
+    Returns:
+        nothing
+    """
+    for index, (start, stop, _, _) in enumerate(strips(height, rows)):
+        strip = np.array(npy_rows(source, start, stop))
+        labels, _ = components.label(strip == 0 if invert else strip)
+        output = npy_rows(target, start, stop, 'r+')
+        output[:] = components.lookup(index, values, background)[labels]
+        output.flush()
+        del output
+
+
+def morphology(source, target, height, rows, operation, size):
+    """
+    Apply a morphological operation strip by strip
+
+    Strips are read with a halo of rows so that the operation gives the
+    same result as on the whole image
+
+    Args:
+        source (string): .npy file of a binary image
+        target (string): .npy file to write the result to
+        height (int): image height
+        rows (int): rows of a strip
+        operation (int): cv2.MORPH_CLOSE or cv2.MORPH_OPEN
+        size (int): size of the square kernel
+
+    Returns:
+        nothing
+    """
+    kernel_ = np.ones((size, size), dtype=np.uint8)
+    for start, stop, read_start, read_stop in strips(height, rows, 2 * size):
+        strip = cv2.morphologyEx(np.array(npy_rows(source, read_start, read_stop)),
+                                 operation, kernel_)
+        output = npy_rows(target, start, stop, 'r+')
+        output[:] = strip[start - read_start:stop - read_start]
+        output.flush()
+        del output
+
+
+def tiled_leaf_mask(image, mask_file, filling_mode=FILL['FLOOD'], smooth_boundary=False,
+                    use_lut=False, budget=256 * 1024 * 1024, work_dir=None):
+    """
+    Generate a mask of the leaf strip by strip within a memory budget
+
+    The marker is generated strip by strip and kept in memory mapped files,
+    components of the marker are stitched across strip seams to select the
+    largest one. Flood filling fills holes of the leaf not touching the
+    image border.
+
+    Args:
+        image (ndarray or string): bgr image, or a .npy file of it mapped strip by strip
+        mask_file (string): .npy file to write the mask to, 255 where leaf is
+        filling_mode (string {no, flood, threshold, morph}):
+            how holes should be filled in segmented leaf
+        smooth_boundary (boolean): should leaf boundary smoothed or not
+        use_lut (boolean): mark colors with a compiled lookup table of the rules
+        budget (int): approximate bytes a strip may take while processed
+        work_dir (string or None): directory of intermediate files, temporary if None
+
+    Returns:
+        nothing
+
+    Raises:
+        ValueError if image has no foreground object with message NO_LEAF
+    """
+    if isinstance(image, str):
+        height, width = np.load(image, mmap_mode='r').shape[:2]
+
+        def image_rows(start, stop):
+            return np.array(npy_rows(image, start, stop))
+    else:
+        height, width = image.shape[:2]
+
+        def image_rows(start, stop):
+            return image[start:stop]
+
+    closing_size, kernel_size = 50, 15
+    rows = strip_rows(width, budget)
+    with tempfile.TemporaryDirectory(dir=work_dir) as folder:
+        marker_file = os.path.join(folder, 'marker.npy')
+        largest_file = os.path.join(folder, 'largest.npy')
+        create_npy(marker_file, (height, width))
+        create_npy(largest_file, (height, width))
+
+        # mark strips and label their components
+        components = StripComponents(connectivity=8)
+        for start, stop, _, _ in strips(height, rows):
+            strip = image_rows(start, stop)
+            ensure_color(strip)
+            marker = image_marker(strip, use_lut).view(np.uint8)
+
+            output = npy_rows(marker_file, start, stop, 'r+')
+            output[:] = marker
+            output.flush()
+            del output
+
+            components.add(marker, start == 0, stop == height)
+
+        areas, _ = components.resolve()
+        if not len(areas):
+            raise ValueError(NO_LEAF)
+        largest = components.parent[np.argmax(areas)]
+        largest_area = areas.max()
+
+        relabel(marker_file, largest_file, height, rows, components,
+                np.where(components.parent == largest, 255, 0).astype(np.uint8), 0)
+
+        if filling_mode in (FILL['FLOOD'], FILL['THRESHOLD']):
+            # components of the background, flood fill spreads to 4 neighbors
+            connectivity = 4 if filling_mode == FILL['FLOOD'] else 8
+            holes = StripComponents(connectivity)
+            for start, stop, _, _ in strips(height, rows):
+                holes.add(np.array(npy_rows(largest_file, start, stop)) == 0,
+                          start == 0, stop == height)
+            hole_areas, hole_border = holes.resolve()
+
+            if filling_mode == FILL['FLOOD']:
+                filled = ~hole_border
+            else:
+                filled = hole_areas < int(0.3 * largest_area)
+
+            # the leaf is the background of its holes
+            relabel(largest_file, marker_file, height, rows, holes,
+                    np.where(filled, 255, 0).astype(np.uint8), 255, invert=True)
+            marker_file, largest_file = largest_file, marker_file
+        elif filling_mode == FILL['MORPH']:
+            rows_ = strip_rows(width, budget, 2 * closing_size)
+            morphology(largest_file, marker_file, height, rows_, cv2.MORPH_CLOSE, closing_size)
+            marker_file, largest_file = largest_file, marker_file
+
+        if smooth_boundary:
+            rows_ = strip_rows(width, budget, 2 * kernel_size)
+            morphology(largest_file, marker_file, height, rows_, cv2.MORPH_OPEN, kernel_size)
+            marker_file, largest_file = largest_file, marker_file
+
+        create_npy(mask_file, (height, width))
+        for start, stop, _, _ in strips(height, rows):
+            output = npy_rows(mask_file, start, stop, 'r+')
+            output[:] = npy_rows(largest_file, start, stop)
+            output.flush()
+            del output
+
+
+def tiled_segment(image, output_file, filling_mode=FILL['FLOOD'], smooth_boundary=False,
+                  marker_intensity=0, use_lut=False, budget=256 * 1024 * 1024, work_dir=None):
+    """
+    Segment leaf from a large image strip by strip within a memory budget
+
+    Args:
+        image (ndarray or string): bgr image, or a .npy file of it mapped strip by strip
+        output_file (string): .npy file to write the output to through a memory map
+        filling_mode, smooth_boundary, use_lut, budget, work_dir: see tiled_leaf_mask
+        marker_intensity (int in rgb_range): should output background marker based
+                                             on this intensity value as foreground value
+
+    Returns:
+        np.memmap of the output, a mask to indicate where leaf is in the image
+        or the segmented image based on marker_intensity value
+    """
+    if marker_intensity > 0:
+        tiled_leaf_mask(image, output_file, filling_mode, smooth_boundary, use_lut,
+                        budget, work_dir)
+        height, width = np.load(output_file, mmap_mode='r').shape
+        for start, stop, _, _ in strips(height, strip_rows(width, budget)):
+            output = npy_rows(output_file, start, stop, 'r+')
+            cv2.threshold(np.array(output), 0, marker_intensity, cv2.THRESH_BINARY,
+                          dst=output)
+            output.flush()
+            del output
+
+        return np.load(output_file, mmap_mode='r')
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as folder:
+        mask_file = os.path.join(folder, 'mask.npy')
+        tiled_leaf_mask(image, mask_file, filling_mode, smooth_boundary, use_lut,
+                        budget, folder)
+        height, width = np.load(mask_file, mmap_mode='r').shape
+
+        create_npy(output_file, (height, width, 3))
+        for start, stop, _, _ in strips(height, strip_rows(width, budget)):
+            if isinstance(image, str):
+                strip = np.array(npy_rows(image, start, stop))
+            else:
+                strip = image[start:stop]
+            # apply marker to original image, masked pixels are left untouched
+            output = npy_rows(output_file, start, stop, 'r+')
+            output[:] = cv2.bitwise_and(strip, strip,
+                                        mask=np.array(npy_rows(mask_file, start, stop)))
+            output.flush()
+            del output
+
+    return np.load(output_file, mmap_mode='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('tiled')
+    parser.add_argument('-m', '--marker_intensity', type=rgb_range, default=0,
+                        help='Output image will be as black background and foreground '
+                             'with integer value specified here')
+    parser.add_argument('-f', '--fill', choices=['no', 'flood', 'threshold', 'morph'],
+                        help='Change hole filling technique for holes appearing in segmented output',
+                        default='flood')
+    parser.add_argument('-s', '--smooth', action='store_true',
+                        help='Output image with smooth edges')
+    parser.add_argument('-l', '--lut', action='store_true',
+                        help='Mark colors with a lookup table of the color rules')
+    parser.add_argument('-b', '--budget', type=int, default=256,
+                        help='Approximate megabytes a strip of the image may take while processed')
+    parser.add_argument('-w', '--work_dir',
+                        help='Directory of intermediate memory mapped files, '
+                             'system temporary directory if not specified')
+    parser.add_argument('image_source',
+                        help='A .npy file of a bgr image, mapped strip by strip, '
+                             'or an image file, which is decoded whole')
+    parser.add_argument('output',
+                        help='A .npy file written through a memory map, or an image file '
+                             'encoded from it')
+    args = parser.parse_args()
+
+    if args.image_source.endswith('.npy'):
+        image = args.image_source
+    else:
+        image = read_image_file(args.image_source)
+
+    output_file = args.output
+    if not output_file.endswith('.npy'):
+        output_file = os.path.splitext(args.output)[0] + '.tmp.npy'
+
+    output = tiled_segment(image, output_file, FILL[args.fill.upper()], args.smooth,
+                           args.marker_intensity, args.lut, args.budget * 1024 * 1024,
+                           args.work_dir)
+
+    if output_file != args.output:
+        cv2.imwrite(args.output, output)
+        del output
+        os.remove(output_file)
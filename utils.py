@@ -1,3 +1,4 @@
+import struct
 import numpy as np
 import cv2
 
@@ -8,14 +9,65 @@ IMAGE_NOT_READ = 'IMAGE_NOT_READ'
 # error message when image is not colored while it should be
 NOT_COLOR_IMAGE = 'NOT_COLOR_IMAGE'
 
+# error message when image has no leaf to segment
+NO_LEAF = 'NO_LEAF'
+
+# read modes decoding images reduced by a scale, jpeg images are decoded
+# reduced directly, other formats are decoded then resized
+REDUCED_READ_MODES = {
+    cv2.IMREAD_COLOR: {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    },
+    cv2.IMREAD_GRAYSCALE: {
+        1: cv2.IMREAD_GRAYSCALE,
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    },
+}
+
+# scales images can be decoded reduced by
+DECODE_SCALES = (1, 2, 4, 8)
+
+# jpeg start of frame markers, which hold the image size
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def reduced_read_mode(read_mode, decode_scale):
+    """
+    Get the read mode decoding images reduced by a scale
+
+    Args:
+        read_mode: cv2.IMREAD_COLOR or cv2.IMREAD_GRAYSCALE, any mode if decode_scale is 1
+        decode_scale (int in DECODE_SCALES): factor to reduce width and height by
+
+    Returns:
+        read mode of cv2
+
+    Raises:
+        ValueError if images can't be decoded reduced by decode_scale in read_mode
+    """
+    if decode_scale == 1:
+        return read_mode
+
+    if read_mode not in REDUCED_READ_MODES or decode_scale not in DECODE_SCALES:
+        raise ValueError('Can not decode reduced by {} in read mode {}'
+                         .format(decode_scale, read_mode))
+
+    return REDUCED_READ_MODES[read_mode][decode_scale]
+
 
-def read_image(file_path, read_mode=cv2.IMREAD_COLOR):
+def read_image(file_path, read_mode=cv2.IMREAD_COLOR, decode_scale=1):
     """
     Read image file with all preprocessing needed
 
     Args:
         file_path: absolute file_path of an image file
         read_mode: whether image reading mode is rgb, grayscale or somethin
+        decode_scale (int in DECODE_SCALES): factor to reduce width and height by while decoding
 
     Returns:
         np.ndarray of the read image or None if couldn't read
@@ -24,7 +76,31 @@ def read_image(file_path, read_mode=cv2.IMREAD_COLOR):
         ValueError if image could not be read with message IMAGE_NOT_READ
     """
     # read image file in grayscale
-    image = cv2.imread(file_path, read_mode)
+    image = cv2.imread(file_path, reduced_read_mode(read_mode, decode_scale))
+
+    if image is None:
+        raise ValueError(IMAGE_NOT_READ)
+    else:
+        return image
+
+
+def decode_image(data, read_mode=cv2.IMREAD_COLOR, decode_scale=1):
+    """
+    Decode an image file already read into memory
+
+    Args:
+        data (bytes): content of an image file
+        read_mode: whether image reading mode is rgb, grayscale or somethin
+        decode_scale (int in DECODE_SCALES): factor to reduce width and height by while decoding
+
+    Returns:
+        np.ndarray of the decoded image
+
+    Raises:
+        ValueError if image could not be decoded with message IMAGE_NOT_READ
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                         reduced_read_mode(read_mode, decode_scale))
 
     if image is None:
         raise ValueError(IMAGE_NOT_READ)
@@ -32,6 +108,71 @@ def read_image(file_path, read_mode=cv2.IMREAD_COLOR):
         return image
 
 
+def image_size(data):
+    """
+    Get the size of a jpeg or png image from its header, without decoding it
+
+    Args:
+        data (bytes): content of an image file, or its beginning
+
+    Returns:
+        tuple of height and width, None if not found
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return height, width
+
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    # walk jpeg segments up to the start of frame
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # fill byte
+            position += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a segment
+            position += 2
+        elif marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[position + 5:position + 9])
+            return height, width
+        else:
+            position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+
+    return None
+
+
+def original_size(data, reduced_shape, decode_scale):
+    """
+    Get the size an image decoded reduced by a scale has at full scale
+
+    Args:
+        data (bytes): content of the image file
+        reduced_shape (tuple): shape of the reduced image
+        decode_scale (int in DECODE_SCALES): factor the image was reduced by
+
+    Returns:
+        tuple of height and width
+    """
+    size = image_size(data)
+    if size is None:
+        # not a jpeg or png header, decode it whole
+        return decode_image(data).shape[:2]
+
+    height, width = size
+
+    # decoding rotates the image by its exif orientation, swapping its sides
+    if abs(reduced_shape[0] - height / decode_scale) > 1 \
+            and abs(reduced_shape[0] - width / decode_scale) <= 1:
+        height, width = width, height
+
+    return height, width
+
+
 def ensure_color(image):
     """
     Ensure that an image is colored
@@ -72,7 +213,6 @@ def excess_green(image, scale = 2):
     ensure_color(image)
 
     bgr_sum = np.sum(image, axis=2)
-    debug(bgr_sum, 'green bgr sum')
 
     blues = div0(image[:, :, 0], bgr_sum)
     greens = div0(image[:, :, 1], bgr_sum)
@@ -124,6 +264,27 @@ def index_diff(image, green_scale=2.0, red_scale=1.4):
     return green_index - red_index
 
 
+def mask_iou(mask, other):
+    """
+    Compute intersection over union of two masks
+
+    Args:
+        mask: mask with nonzero foreground
+        other: mask of same size with nonzero foreground
+
+    Returns:
+        intersection over union in range 0 to 1, 1 if both masks are empty
+    """
+    mask = mask != 0
+    other = other != 0
+
+    union = np.count_nonzero(mask | other)
+    if union == 0:
+        return 1.0
+
+    return np.count_nonzero(mask & other) / union
+
+
 def debug(value, name=None):
     if isinstance(value, np.ndarray):
         name = 'ndarray' if name is None else name
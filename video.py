@@ -0,0 +1,325 @@
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+
+from utils import *
+from background_marker import *
+from segment import Segmenter, rgb_range
+from mask_io import MASK_FORMATS, mask_filename, write_mask
+
+
+# file extensions written as a video rather than a folder of frames
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov')
+
+
+def read_frames(source):
+    """
+    Read frames of a video or of an ordered image sequence
+
+    Args:
+        source (string): video file, printf pattern of image files such as
+                         frames/%04d.png, or folder of image files read in
+                         order of their names
+
+    Returns:
+        generator of bgr frames
+    """
+    if os.path.isdir(source):
+        for entry in sorted(os.listdir(source)):
+            path = os.path.join(source, entry)
+            if os.path.isfile(path):
+                try:
+                    yield read_image(path)
+                except ValueError:
+                    # not an image file
+                    continue
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(IMAGE_NOT_READ)
+    try:
+        while True:
+            read, frame = capture.read()
+            if not read:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+def source_fps(source, default=25.0):
+    """
+    Get frames per second of a video, default for image sequences
+    """
+    if os.path.isdir(source):
+        return default
+
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+
+    return fps if fps > 0 else default
+
+
+class VideoSegmenter:
+    """
+    Segments frames of a video, seeding each frame from the mask of the previous one
+
+    A frame is segmented only in the bounding box of the previous leaf padded
+    by a margin, and a full pass is made instead on the first frame, when the
+    leaf reaches the padded box edge or when its area changes too much
+    """
+
+    def __init__(self, segmenter, margin=0.25, min_margin=16, max_change=0.2):
+        """
+        Args:
+            segmenter (Segmenter): segmenter of the frames
+            margin (float): padding of the previous leaf bounding box, relative to its size
+            min_margin (int): padding of the previous leaf bounding box at least, in pixels
+            max_change (float): relative change of leaf area from the previous frame
+                                above which the frame is segmented in a full pass
+        """
+        self.segmenter = segmenter
+        self.margin = margin
+        self.min_margin = min_margin
+        self.max_change = max_change
+
+        self.bounding_box = None
+        self.area = 0
+        self.counts = {'full': 0, 'seeded': 0}
+
+    def reset(self):
+        """
+        Forget the previous frame, the next one is segmented in a full pass
+        """
+        self.bounding_box = None
+        self.area = 0
+
+    def roi(self, shape):
+        """
+        Get the region of interest of the next frame, around the previous leaf
+
+        Args:
+            shape (tuple): height and width of the frame
+
+        Returns:
+            tuple of row and column slices
+        """
+        x, y, w, h = self.bounding_box
+        pad_x = max(self.min_margin, int(w * self.margin))
+        pad_y = max(self.min_margin, int(h * self.margin))
+
+        return (slice(max(0, y - pad_y), min(shape[0], y + h + pad_y)),
+                slice(max(0, x - pad_x), min(shape[1], x + w + pad_x)))
+
+    def seeded_mask(self, frame):
+        """
+        Segment a frame in the region of interest around the previous leaf
+
+        Args:
+            frame (ndarray): bgr frame
+
+        Returns:
+            ndarray: leaf mask of the frame, or None if a full pass is needed
+        """
+        rows, columns = self.roi(frame.shape)
+        try:
+            roi_mask = self.segmenter.mask(frame[rows, columns])
+        except ValueError as err:
+            if str(err) != NO_LEAF:
+                raise
+            # no leaf left in the region
+            return None
+
+        # the leaf may go on beyond region edges that are not image edges
+        if (rows.start > 0 and roi_mask[0].any()) \
+                or (rows.stop < frame.shape[0] and roi_mask[-1].any()) \
+                or (columns.start > 0 and roi_mask[:, 0].any()) \
+                or (columns.stop < frame.shape[1] and roi_mask[:, -1].any()):
+            return None
+
+        area = np.count_nonzero(roi_mask)
+        if abs(area - self.area) > self.max_change * self.area:
+            return None
+
+        mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+        mask[rows, columns] = roi_mask
+
+        return mask
+
+    def full_mask(self, frame):
+        """
+        Segment a whole frame
+
+        Args:
+            frame (ndarray): bgr frame
+
+        Returns:
+            ndarray: leaf mask of the frame, or None if there is no leaf in it
+
+        Raises:
+            ValueError if frame is not a color image with message NOT_COLOR_IMAGE
+        """
+        try:
+            return self.segmenter.mask(frame)
+        except ValueError as err:
+            if str(err) != NO_LEAF:
+                raise
+            return None
+
+    def mask(self, frame):
+        """
+        Generate the leaf mask of the next frame
+
+        A frame without leaf gets an empty mask, and the next one is segmented
+        in a full pass
+
+        Args:
+            frame (ndarray): bgr frame
+
+        Returns:
+            tuple[0] (ndarray): mask with nonzero values where leaf is in the frame
+            tuple[1] (string): 'seeded' if found around the previous leaf, otherwise 'full'
+        """
+        mask = None
+        if self.bounding_box is not None:
+            mask = self.seeded_mask(frame)
+
+        mode = 'seeded'
+        if mask is None:
+            mode = 'full'
+            mask = self.full_mask(frame)
+
+        self.counts[mode] += 1
+        if mask is None:
+            self.reset()
+            return np.zeros(frame.shape[:2], dtype=np.uint8), mode
+
+        self.bounding_box = cv2.boundingRect(mask)
+        self.area = np.count_nonzero(mask)
+
+        return mask, mode
+
+    def segment(self, frame):
+        """
+        Segment leaf from the next frame
+
+        Args:
+            frame (ndarray): bgr frame
+
+        Returns:
+            tuple[0] (ndarray): A mask to indicate where leaf is in the frame
+                                or the segmented frame based on marker_intensity value
+            tuple[1] (string): see mask
+        """
+        mask, mode = self.mask(frame)
+
+        return self.segmenter.output(frame, mask), mode
+
+
+def segment_video(source, output, filling_mode=FILL['FLOOD'], smooth_boundary=False,
+                  marker_intensity=0, use_lut=False, mask_format='image',
+                  margin=0.25, max_change=0.2):
+    """
+    Segment every frame of a video or image sequence
+
+    Args:
+        source (string): see read_frames
+        output (string): video file to write, or folder to write a file per frame in
+        filling_mode, smooth_boundary, marker_intensity, use_lut: see segment_leaf
+        mask_format (string in MASK_FORMATS): format of the frame files of mask outputs
+        margin, max_change: see VideoSegmenter
+
+    Returns:
+        tuple[0] (int): number of frames
+        tuple[1] (dict): number of frames segmented 'full' and 'seeded'
+        tuple[2] (float): seconds segmenting and writing took
+    """
+    if mask_format != 'image':
+        marker_intensity = marker_intensity or 255
+    video_segmenter = VideoSegmenter(
+        Segmenter(filling_mode, smooth_boundary, marker_intensity, use_lut),
+        margin=margin, max_change=max_change)
+
+    writer = None
+    to_video = output.lower().endswith(VIDEO_EXTENSIONS)
+    if not to_video:
+        os.makedirs(output, exist_ok=True)
+
+    count = 0
+    start_time = time.time()
+    try:
+        for frame in read_frames(source):
+            ensure_color(frame)
+            output_frame, _ = video_segmenter.segment(frame)
+
+            if to_video:
+                if marker_intensity > 0:
+                    output_frame = cv2.cvtColor(output_frame, cv2.COLOR_GRAY2BGR)
+                if writer is None:
+                    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'MJPG'),
+                                             source_fps(source),
+                                             (output_frame.shape[1], output_frame.shape[0]))
+                writer.write(output_frame)
+            else:
+                frame_file = os.path.join(output, 'frame_{:06d}_marked.png'.format(count))
+                if mask_format != 'image':
+                    write_mask(mask_filename(frame_file, mask_format), output_frame, mask_format)
+                else:
+                    cv2.imwrite(frame_file, output_frame)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.release()
+
+    return count, video_segmenter.counts, time.time() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('video')
+    parser.add_argument('-m', '--marker_intensity', type=rgb_range, default=0,
+                        help='Output image will be as black background and foreground '
+                             'with integer value specified here')
+    parser.add_argument('-f', '--fill', choices=['no', 'flood', 'threshold', 'morph'],
+                        help='Change hole filling technique for holes appearing in segmented output',
+                        default='flood')
+    parser.add_argument('-s', '--smooth', action='store_true',
+                        help='Output image with smooth edges')
+    parser.add_argument('-l', '--lut', action='store_true',
+                        help='Mark colors with a lookup table of the color rules')
+    parser.add_argument('--mask_format', choices=list(MASK_FORMATS), default='image',
+                        help='Format of frame files of the leaf mask when output is a folder, '
+                             'implies mask output')
+    parser.add_argument('--margin', type=float, default=0.25,
+                        help='Padding of the previous leaf bounding box a frame is segmented in, '
+                             'relative to the box size')
+    parser.add_argument('--max_change', type=float, default=0.2,
+                        help='Relative change of leaf area between frames above which a frame '
+                             'is segmented in a full pass')
+    parser.add_argument('source',
+                        help='A video file, a pattern of image files such as frames/%%04d.png '
+                             'or a folder of images in order of their names')
+    parser.add_argument('output',
+                        help='A video file to write, or a folder to write a file per frame in')
+    args = parser.parse_args()
+
+    try:
+        count, counts, elapsed = segment_video(
+            args.source, args.output, FILL[args.fill.upper()], args.smooth,
+            args.marker_intensity, args.lut, args.mask_format, args.margin, args.max_change)
+    except ValueError as err:
+        if str(err) == IMAGE_NOT_READ:
+            print('Error: Could not read video: ', args.source)
+        elif str(err) == NOT_COLOR_IMAGE:
+            print('Error: Not color video: ', args.source)
+        else:
+            raise
+        exit(1)
+
+    print('Segmented {} frames in {:.2f} seconds ({:.2f} frames per second), '
+          '{} full passes and {} seeded from the previous frame'
+          .format(count, elapsed, count / elapsed if elapsed > 0 else 0.0,
+                  counts['full'], counts['seeded']))